@@ -3,46 +3,353 @@
 bson gevent Server
 '''
 
+import time
+import errno
 import logging
 import gevent
 import traceback
 
+from collections import deque
 from gevent import socket
+from gevent.event import Event
+from gevent.pool import Pool
 from gevent.server import StreamServer
-from gevent.queue import Queue
 
 from util.sockutil import set_tcp_keepalive
+from util.metrics import ConnectionMetrics, now
+
+
+
+class SendQueue(object):
+  '''FIFO of pending writes that keeps count of the bytes it holds. Writes
+  are kept with the time (util.metrics.now) they were queued at. Transports
+  only hold one while they have a backlog.'''
+  __slots__ = ('items', 'bytes', 'writable')
+
+  def __init__(self):
+    self.items = deque()
+    self.bytes = 0
+    self.writable = Event() # set whenever a batch has been sent.
+
+  def __len__(self):
+    return len(self.items)
+
+  def put(self, data, queued=None):
+    self.items.append((data, queued or now()))
+    self.bytes += len(data)
+
+  def pop(self):
+    '''Removes and returns the oldest write (data, time queued). Raises
+    IndexError if empty.'''
+    item = self.items.popleft()
+    self.bytes -= len(item[0])
+    return item
+
+  def nextSize(self):
+    '''Returns the size of the oldest write, or None if empty.'''
+    return len(self.items[0][0]) if self.items else None
+
+
+
+
+
+class YieldPolicy(object):
+  '''When a greenlet working through a backlog (received documents, queued
+  sends) lets the others run: once it did `docs` units of work, or handled
+  `bytes` bytes, or worked `micros` microseconds (wall clock) since it last
+  yielded, whichever comes first. A limit of 0 or None is not checked, and
+  docs=1 yields after every unit of work.
+
+  Time is wall clock, not CPU time: greenlets only switch when they yield,
+  so the wall time since a greenlet last yielded is how long it has held
+  every other connection up, which is what the limit bounds. (Process CPU
+  time would also miss page faults and the like, and costs a syscall.)
+
+  One policy serves many connections (see Factory.yield_policy). The work
+  done since the last yield is kept in a YieldBudget per working greenlet.
+  `yields` counts the yields made under the policy; connections count
+  theirs in their metrics, and the stats dump has the rate.
+  '''
+  __slots__ = ('docs', 'bytes', 'micros', 'yields')
+
+  def __init__(self, docs=64, bytes=262144, micros=1000):
+    self.docs = docs
+    self.bytes = bytes
+    self.micros = micros
+    self.yields = 0
+
+  def budget(self):
+    return YieldBudget(self)
+
+
+
+class YieldBudget(object):
+  '''Work done under a YieldPolicy since the last yield.'''
+  __slots__ = ('policy', 'docs', 'bytes', 'since')
+
+  def __init__(self, policy):
+    self.policy = policy
+    self.reset()
+
+  def reset(self):
+    self.docs = 0
+    self.bytes = 0
+    self.since = time.time() if self.policy.micros else 0
+
+  def spend(self, bytes=0):
+    '''Counts a unit of work of `bytes` bytes, and yields if the policy says
+    it is time to. Returns whether it yielded.'''
+    policy = self.policy
+    self.docs += 1
+    self.bytes += bytes
+    if (policy.docs and self.docs >= policy.docs) \
+        or (policy.bytes and self.bytes >= policy.bytes) \
+        or (policy.micros and \
+          (time.time() - self.since) * 1000000 >= policy.micros):
+      gevent.sleep(0) # cooperative yield
+      policy.yields += 1
+      self.reset()
+      return True
+    return False
+
+
+
+default_yield_policy = YieldPolicy()
+
+
+
+
+
+def raw_socket(sock):
+  '''Returns the (non-blocking) socket under gevent socket `sock`, or None
+  if `sock` is not a gevent socket (or gevent no longer has `_sock`). With
+  None, transports only use the public, blocking socket methods.'''
+  if isinstance(sock, socket.socket):
+    return getattr(sock, '_sock', None)
+  return None
+
+
+
+
 
 class Transport(object):
-  '''Greenlet-safe socket wrapper to emulate twisteds Transport'''
-  __slots__ = ('sock', 'queue', 'send_greenlet')
+  '''Greenlet-safe socket wrapper to emulate twisteds Transport
 
-  def __init__(self, socket):
-    self.sock = socket
-    self.queue = Queue(maxsize=1000) # maxsize just in case...
-    self.send_greenlet = gevent.spawn(self._sendloop)
+  Writes go straight to the socket, from the writing greenlet, when nothing
+  is queued and the socket takes them whole. Otherwise they are queued, and
+  a flusher greenlet is spawned to send the queue; it exits (dropping the
+  queue) once the queue is empty. Idle connections thus cost no greenlet and
+  no queue at all.
+
+  The send queue is bounded by bytes (`queue_bytes`). A write that does not
+  fit is handled according to `queue_policy`:
+    block       -- the writing greenlet waits until enough has been sent.
+    drop-newest -- the new write is discarded.
+    drop-oldest -- the oldest pending writes are discarded to make room.
+    disconnect  -- the connection (a slow consumer) is dropped.
+  A write always fits in an empty queue, whatever its size.
+
+  The protocol is told when the queue grows past `high_watermark` bytes
+  (sendQueueHigh) and when it drains back under `low_watermark` bytes
+  (sendQueueLow).
 
-  def _sendloop(self):
-    '''The need for this sendloop is that multiple greenlets may attempt to
-    call `write` simultaneously. Thus, the call to `sock.sendall` must be
+  The flusher, and the protocol reading the connection, let other greenlets
+  run as `yield_policy` (a YieldPolicy) says.
+
+  Traffic is counted in `metrics` (util.metrics.ConnectionMetrics).
+  '''
+  __slots__ = ('sock', 'queue', 'flusher', 'connected', 'protocol',
+               'queue_bytes', 'queue_policy', 'high_watermark',
+               'low_watermark', 'above_watermark', 'metrics', 'yield_policy')
+
+  policies = ('block', 'drop-newest', 'drop-oldest', 'disconnect')
+
+  batch_bytes = 65536 # queued writes coalesced into a single send, at most.
+
+  def __init__(self, socket, queue_bytes=None, queue_policy=None,
+      yield_policy=None):
+    self.sock = socket
+    self.protocol = None
+    self.queue = None # while there is a backlog.
+    self.queue_bytes = queue_bytes or 33554432 # 2 max size bson docs.
+    self.queue_policy = queue_policy or 'block'
+    if self.queue_policy not in self.policies:
+      raise ValueError('unknown send queue policy: %s' % self.queue_policy)
+    self.high_watermark = self.queue_bytes * 3 / 4
+    self.low_watermark = self.queue_bytes / 4
+    self.above_watermark = False
+    self.metrics = ConnectionMetrics()
+    self.yield_policy = yield_policy or default_yield_policy
+    self.flusher = None
+    self.connected = True
+
+  def _send(self, data):
+    '''Sends as much of `data` as the socket takes right now, without
+    blocking. Returns the number of bytes sent.'''
+    tic = now()
+    try:
+      sent = raw_socket(self.sock).send(data)
+    except socket.error, e:
+      if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+        return 0
+      self.loseConnection() # the reader sees the connection closed.
+      return 0
+
+    metrics = self.metrics
+    metrics.bytes_out += sent
+    if sent == len(data):
+      toc = now()
+      metrics.send_latency.record((toc - tic) / 1000)
+      metrics.queue_wait.record((toc - tic) / 1000)
+      metrics.docs_out += 1
+      metrics.sends += 1
+    return sent
+
+  def _flush(self):
+    '''Sends the queue until it is empty, then exits. The need for a queue
+    (and a single greenlet sending it) is that multiple greenlets may attempt
+    to call `write` simultaneously. Thus, the call to `sock.sendall` must be
     protected. This could instead be achieved with a Semaphore, but that would
     perhaps block high priority greenlets. The approach here, using a send
     queue, seems to be the best way to keep faulty or slow sockets from
     affecting others.
+
+    Everything already queued (up to `batch_bytes`) is flushed together, so
+    many small writes cost one syscall and one yield rather than one each.
     '''
-    while True:
-      self.sock.sendall(self.queue.get())
-      gevent.sleep(0) # cooperative yield
+    try:
+      self._flushQueue()
+    except socket.error:
+      self.loseConnection()
+    finally:
+      self.flusher = None
+      if not self.queue:
+        self.queue = None
+
+  def _flushQueue(self):
+    queue = self.queue
+    metrics = self.metrics
+    budget = self.yield_policy.budget()
+    while queue:
+      data, queued = queue.pop()
+      batch = [data]
+      stamps = [queued]
+      size = len(data)
+      while queue and size + queue.nextSize() <= self.batch_bytes:
+        data, queued = queue.pop()
+        batch.append(data)
+        stamps.append(queued)
+        size += len(data)
+
+      tic = now()
+      self.sock.sendall(batch[0] if len(batch) == 1 else ''.join(batch))
+      toc = now()
+      metrics.send_latency.record((toc - tic) / 1000)
+      for queued in stamps:
+        metrics.queue_wait.record((toc - queued) / 1000)
+      metrics.bytes_out += size
+      metrics.docs_out += len(batch)
+      metrics.sends += 1
+
+      queue.writable.set() # wake up blocked writers.
+      if self.above_watermark and queue.bytes <= self.low_watermark:
+        self.above_watermark = False
+        if self.protocol:
+          self.protocol.sendQueueLow()
+
+      if budget.spend(size):
+        metrics.yields += 1
 
 
   def write(self, data):
-    self.queue.put(data)
+    '''Sends (or queues) `data`. Returns False if it was dropped.'''
+    if not self.connected:
+      return False # connection lost.
+
+    queue = self.queue
+    if not queue and not self.flusher and raw_socket(self.sock):
+      sent = self._send(data)
+      if sent == len(data) or not self.connected:
+        return self.connected
+      if sent:
+        data = data[sent:] # the rest waits for the flusher.
+
+    elif queue and queue.bytes + len(data) > self.queue_bytes:
+      if self.queue_policy == 'drop-newest':
+        self.metrics.drops += 1
+        return False
+
+      elif self.queue_policy == 'disconnect':
+        self.metrics.drops += 1
+        self.loseConnection()
+        return False
+
+      elif self.queue_policy == 'drop-oldest':
+        while queue and queue.bytes + len(data) > self.queue_bytes:
+          queue.pop()
+          self.metrics.drops += 1
+
+      else: # block
+        while queue and queue.bytes + len(data) > self.queue_bytes:
+          queue.writable.clear()
+          queue.writable.wait()
+          if not self.connected:
+            return False
+        queue = self.queue # dropped if the flusher emptied it.
+
+    if queue is None:
+      queue = self.queue = SendQueue()
+    queue.put(data)
+    if not self.flusher:
+      self.flusher = gevent.spawn(self._flush)
+    if queue.bytes > self.metrics.queue_peak:
+      self.metrics.queue_peak = queue.bytes
+    if not self.above_watermark and queue.bytes >= self.high_watermark:
+      self.above_watermark = True
+      if self.protocol:
+        self.protocol.sendQueueHigh()
+    return True
 
   def read(self, bytes):
-    return self.sock.recv(bytes)
+    data = self.sock.recv(bytes)
+    self.metrics.bytes_in += len(data)
+    return data
+
+  def readInto(self, buffer, bytes):
+    count = self.sock.recv_into(buffer, bytes)
+    self.metrics.bytes_in += count
+    return count
+
+  def readIntoNow(self, buffer, bytes):
+    '''Like readInto, but returns None rather than waiting for data.'''
+    raw = raw_socket(self.sock)
+    if not raw:
+      return self.readInto(buffer, bytes)
+
+    try:
+      count = raw.recv_into(buffer, bytes)
+    except socket.error, e:
+      if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
+        raise
+      return None
+    self.metrics.bytes_in += count
+    return count
+
+  def waitReadable(self):
+    '''Waits until there is something to read (data, or the connection
+    closing), without holding any read buffer meanwhile.'''
+    # peeking blocks through the socket's own (public) wait, which closing
+    # the socket cancels; a bare wait_read on the fd would never wake up.
+    self.sock.recv(1, socket.MSG_PEEK)
 
   def loseConnection(self):
-    self.send_greenlet.kill()
+    if self.connected:
+      self.connected = False
+      flusher = self.flusher
+      if flusher and flusher is not gevent.getcurrent():
+        flusher.kill()
+      if self.queue:
+        self.queue.writable.set() # release blocked writers.
     self.sock.close()
 
 
@@ -50,12 +357,32 @@ class Transport(object):
 
 
 class Protocol(object):
-  '''Twisted-like protocol facility.'''
+  '''Twisted-like protocol facility.
+
+  There is one protocol per connection, so protocols have no per instance
+  __dict__: subclasses list their instance attributes in `__slots__`. Slots
+  not set yet (e.g. in protocols made without calling __init__) read as
+  their `defaults`.
+  '''
+  __slots__ = ('transport', 'address', 'factory', 'metrics')
+
+  read_size = 1024
+
+  # metrics: util.metrics.ConnectionMetrics, shared with the transport.
+  defaults = {'transport' : None, 'metrics' : None}
 
   def __init__(self, transport, address, factory):
     self.transport = transport
     self.address = address
     self.factory = factory
+    self.metrics = getattr(transport, 'metrics', None) or ConnectionMetrics()
+
+  def __getattr__(self, name):
+    # only called when regular lookup fails, so it costs set slots nothing.
+    try:
+      return self.defaults[name]
+    except KeyError:
+      raise AttributeError(name)
 
   def connectionMade(self):
     pass
@@ -64,12 +391,28 @@ class Protocol(object):
     pass
 
   def sendData(self, data):
-    self.transport.write(data)
+    return self.transport.write(data)
+
+  def sendQueueHigh(self):
+    '''Called when the send queue grows past its high watermark.'''
+    pass
+
+  def sendQueueLow(self):
+    '''Called when the send queue drains back under its low watermark.'''
+    pass
+
+  def readTransport(self):
+    '''Reads the next chunk off the transport and handles it. Returns the
+    number of bytes read (0 once the connection is closed).'''
+    data = self.transport.read(self.read_size)
+    if data:
+      self.receivedData(data)
+    return len(data)
 
   def receivedData(self, data):
     '''Override this to handle data sent to this service.'''
-    # protocols should cooperatively yield after performing work units
-    # yield with gevent.sleep(0)
+    # protocols should cooperatively yield after performing work units,
+    # e.g. with a budget from self.transport.yield_policy.
     raise NotImplementedError
 
 
@@ -81,21 +424,27 @@ class Factory(object):
 
   protocol = Protocol
 
+  queue_bytes = None # per connection send queue bound (Transport default)
+  queue_policy = None # what to do with writes that do not fit
+  yield_policy = default_yield_policy # when connections let others run.
+
+  metrics = None # util.metrics.Registry of live connections, if any.
+
   def error(self, error):
     logging.error(error)
 
   def transportRead(self, connection):
-    while True:
-      data = None
-      data = connection.transport.read(1024)
-      if not data:
-        break
-      connection.receivedData(data)
+    while connection.readTransport():
+      pass
 
   def handler(self, sock, address, client=None):
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-    transport = Transport(sock)
+    transport = Transport(sock, self.queue_bytes, self.queue_policy,
+      self.yield_policy)
     conn = self.protocol(transport, address, self)
+    transport.protocol = conn
+    if self.metrics:
+      self.metrics.connectionAdded(conn)
     conn.connectionMade()
 
     if client:
@@ -108,14 +457,80 @@ class Factory(object):
       self.error(errstr % (str(e), str(traceback.format_exc())) )
 
     transport.loseConnection()
+    if self.metrics:
+      self.metrics.connectionRemoved(conn)
     conn.connectionLost('Connection Closed')
 
 
 
+class RateLimiter(object):
+  '''Token bucket: allows `rate` events per second on average, in bursts of
+  up to `burst` events.'''
+  __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+  def __init__(self, rate, burst=None):
+    self.rate = float(rate)
+    self.burst = burst or max(1, int(rate))
+    self.tokens = float(self.burst)
+    self.last = time.time()
+
+  def wait(self):
+    '''Takes a token, first waiting for one to be available.'''
+    while True:
+      now = time.time()
+      self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+      self.last = now
+      if self.tokens >= 1:
+        self.tokens -= 1
+        return
+      gevent.sleep((1 - self.tokens) / self.rate)
+
+
+
+
+
 class Server(object):
-  __slots__ = ('server')
-  def __init__(self, address, factory):
-    self.server = StreamServer(address, factory.handler)
+  '''Accepts connections for `factory`.
+
+  Admission control: at most `max_connections` connections are handled at
+  once (a gevent Pool) and at most `accept_rate` new ones per second are
+  let in. Connections over either limit are not accepted yet: they wait in
+  the listen `backlog` (kernel side), costing no greenlet, transport or
+  buffers, until there is room.
+  '''
+  __slots__ = ('server', 'factory', 'pool', 'limiter')
+  def __init__(self, address, factory, reuse_port=False, max_connections=None,
+      backlog=None, accept_rate=None):
+    self.factory = factory
+    self.pool = Pool(max_connections) if max_connections else None
+    self.limiter = RateLimiter(accept_rate) if accept_rate else None
+
+    if reuse_port:
+      address = self.reuseport_listener(address, backlog or 128)
+    if hasattr(address, 'accept'):
+      backlog = None # already listening.
+
+    handler = self.handler if self.limiter else factory.handler
+    # empty pools are falsy, so test for None.
+    spawn = 'default' if self.pool is None else self.pool
+    self.server = StreamServer(address, handler, backlog=backlog, spawn=spawn)
+
+  def handler(self, sock, address):
+    # waiting holds a pool slot, so accepting stops while the rate is hit.
+    self.limiter.wait()
+    self.factory.handler(sock, address)
+
+  @staticmethod
+  def reuseport_listener(address, backlog=128):
+    '''Returns a listening socket bound with SO_REUSEPORT, so that several
+    processes can accept on the same port (the kernel spreads connections).
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
 
   def serve_forever(self):
     self.server.serve_forever()
@@ -170,6 +585,8 @@ class PersistentClient(Client):
 
   __slots__ = Client.__slots__ + ('persist', )
 
+  reconnect_delay = 1 # seconds
+
   def __init__(self, factory):
     super(PersistentClient, self).__init__(factory)
     self.persist = False
@@ -178,7 +595,7 @@ class PersistentClient(Client):
     self.persist = True
     while self.persist:
       super(PersistentClient, self).connect(address, family, type)
-      gevent.sleep(1)
+      gevent.sleep(self.reconnect_delay)
 
   def disconnect(self):
     self.persist = False
@@ -22,6 +22,8 @@ def flipMessage(message):
 class EchoProtocol(Protocol):
   '''Simple echo protocol. Just sends back any received data.'''
 
+  __slots__ = ()
+
   def connectionMade(self):
     logging.info('[EchoProtocol] %s:%d connection made' % self.address)
 
@@ -30,7 +32,7 @@ class EchoProtocol(Protocol):
 
   def receivedData(self, data):
     logging.info('[EchoProtocol] %s:%d received data' % self.address)
-    logging.debug('[EchoProtocol] %s' % data)
+    logging.debug('[EchoProtocol] %s', data)
     self.sendData(data)
 
 
@@ -40,6 +42,8 @@ class EchoProtocol(Protocol):
 class BsonEchoProtocol(BsonProtocol):
   '''Simple echo bsonprotocol. Just sends back any received documents.'''
 
+  __slots__ = ()
+
   def connectionMade(self):
     logging.info('[BsonEchoProtocol] %s:%d connection made' % self.address)
 
@@ -48,7 +52,7 @@ class BsonEchoProtocol(BsonProtocol):
 
   def receivedBson(self, message):
     logging.info('[BsonEchoProtocol] %s:%d received message' % self.address)
-    logging.debug('[BsonEchoProtocol] %s' % message)
+    logging.debug('[BsonEchoProtocol] %s', message)
     self.sendBson(message)
 
 
@@ -56,11 +60,13 @@ class BsonEchoProtocol(BsonProtocol):
 
 class BsonNetworkEchoProtocol(BsonNetworkProtocol):
 
+  __slots__ = ()
+
   def receivedMessage(self, msg):
     msg['_dst'] = msg['_src']
     msg['_src'] = self.factory.clientid
     self.sendMessage(msg)
-    self.log('info', 'echoed message %s' % msg)
+    self.log('info', 'echoed message %s', msg)
 
 
 
@@ -95,7 +101,9 @@ def main():
   factory.protocol = BsonNetworkEchoProtocol
 
   from base import Server
-  server = Server(('', options.port), factory)
+  server = Server(('', options.port), factory, \
+    max_connections=options.clients, backlog=options.backlog, \
+    accept_rate=options.accept_rate)
   server.serve_forever()
 
 
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+'''
+In-process microbenchmarks of the message hot paths (no sockets).
+
+The hot path stages (framing, decoding, dispatch, validation, routing) can
+be saved as a baseline and later compared against it: the run fails (exit
+status 1) when a stage's throughput drops more than the threshold.
+
+  microbench.py --save-baseline microbench.json   # on the reference build
+  microbench.py --baseline microbench.json        # on the change
+'''
+
+import sys
+import json
+import time
+import random
+import logging
+import nanotime
+
+from network import BsonNetworkProtocol, BsonNetworkFactory
+from protocol import BsonProtocol
+from router import BsonRouterProtocol, BsonRouterFactory
+from util import bsoncodec
+from util.bsonbuffer import BsonReceiveBuffer
+from util.bsonscan import LazyDocument
+from util.randomdoc import random_dict
+
+
+class FakeTransport(object):
+  '''Transport stand-in that swallows writes.'''
+
+  def __init__(self):
+    self.written = 0
+
+  def write(self, data):
+    self.written += 1
+    return True
+
+  def loseConnection(self):
+    pass
+
+
+class Options(object):
+  port = 0
+  clientid = 'bench'
+  clients = 10000
+  secret = None
+
+
+class SinkProtocol(BsonNetworkProtocol):
+  def receivedMessage(self, msg):
+    pass
+
+
+class EagerLogProtocol(SinkProtocol):
+  '''The logging behaviour before util.logger: messages are formatted at the
+  call site (str(doc) included) and the level is checked per call.'''
+
+  def log(self, level, message, *args):
+    if not self.factory.logging or not hasattr(self.factory.logging, level):
+      return
+
+    logfn = getattr(self.factory.logging, level)
+    logfn('[BN] [%s] %s' % (self.clientid, message % args))
+
+  def receivedBson(self, doc):
+    self.log('info', 'bson document received')
+    self.log('debug', 'bson document received')
+    if not self.validMessage(doc):
+      self.log('warning', 'data discarded (invalid document)')
+      return
+
+    self.log('info', 'document parsed from %s' % doc['_src'])
+    self.log('debug', 'document parsed %s' % str(doc))
+    self.lastRecvTime = nanotime.nanotime.now()
+    self.receivedMessage(doc)
+
+
+def benchDoc(fields=50):
+  '''A mid sized document addressed to the benchmark factory.'''
+  doc = {'_src' : 'client', '_dst' : Options.clientid}
+  for i in range(0, fields):
+    doc['field%d' % i] = {'list' : range(0, 10), 'text' : 'herp derp' * 4}
+  return doc
+
+
+def randomDicts(count, seed=1):
+  '''`count` documents shaped like the ones the tests send (see
+  util.randomdoc), the same ones on every run.'''
+  rng = random.Random(seed)
+  return [random_dict(rng) for i in range(0, count)]
+
+
+def codecDocs():
+  '''Document shapes for the codec benchmark: name -> document. These are
+  util.randomdoc documents, alone and nested by the dozen and by the
+  hundred (as in test_util).'''
+  dicts = randomDicts(521)
+  nested = lambda docs: dict(('%d' % i, doc) for i, doc in enumerate(docs))
+  return [
+    ('random', dicts[0]),
+    ('x20', nested(dicts[1:21])),
+    ('x500', nested(dicts[21:521])),
+  ]
+
+
+def timePerCall(function, arg, iterations):
+  '''Returns the mean microseconds per call of function(arg).'''
+  tic = time.time()
+  for i in xrange(iterations):
+    function(arg)
+  toc = time.time()
+  return (toc - tic) * 1e6 / iterations
+
+
+def benchLogging(iterations=20000):
+  '''Per message cost of BsonNetworkProtocol.receivedBson with logging at
+  WARNING, before (eager formatting) and after (util.logger).'''
+
+  logging.getLogger().setLevel(logging.WARNING)
+  doc = benchDoc()
+  results = []
+  for name, protocol in [('eager', EagerLogProtocol), ('lazy', SinkProtocol)]:
+    factory = BsonNetworkFactory(Options.clientid, Options())
+    factory.logging = logging
+    if name == 'eager':
+      factory._logging = logging # the module itself, as before.
+
+    conn = protocol(FakeTransport(), ('localhost', 0), factory)
+    conn.clientid = 'client'
+    results.append((name, timePerCall(conn.receivedBson, doc, iterations)))
+  return results
+
+
+def benchCodecs(iterations=20000):
+  '''Encode and decode cost (us per document) of every available codec,
+  for each of the codecDocs shapes. Returns (codec, shape, size, enc, dec).'''
+
+  results = []
+  for name in sorted(bsoncodec.available()):
+    codec = bsoncodec.codec(name)
+    for shape, doc in codecDocs():
+      data = codec.dumps(doc)
+      count = max(10, min(iterations, 2 ** 24 / len(data)))
+      encode = timePerCall(codec.dumps, doc, count)
+      decode = timePerCall(codec.loads, data, count)
+      results.append((name, shape, len(data), encode, decode))
+  return results
+
+
+class FramingProtocol(BsonProtocol):
+  '''Frames documents without decoding them.'''
+  decode_frames = False
+
+  def receivedFrame(self, frame):
+    pass
+
+
+def docMix(dst=Options.clientid, count=100, seed=1):
+  '''A reproducible mix of documents for `dst`, as seen in practice: mostly
+  small ones, some mid sized and a few large ones.'''
+  rand = random.Random(seed)
+  docs = []
+  for i in range(0, count):
+    pick = rand.random()
+    if pick < 0.7:
+      doc = {'seq' : i, 'text' : 'herp derp', 'ok' : True}
+    elif pick < 0.95:
+      doc = benchDoc(5)
+    else:
+      doc = benchDoc(50)
+    doc['_src'] = 'client'
+    doc['_dst'] = dst
+    doc['_sec'] = 'secret'
+    docs.append(doc)
+  return docs
+
+
+def stages():
+  '''Returns [(name, docs, run)]: run() pushes the `docs` through one hot
+  path stage once.'''
+  codec = bsoncodec.default_codec
+  options = Options()
+  options.secret = 'secret'
+
+  mix = docMix()
+  data = [codec.dumps(doc) for doc in mix]
+  stream = ''.join(data)
+  chunks = [stream[i:i + 4096] for i in range(0, len(stream), 4096)]
+
+  def framing():
+    conn = FramingProtocol(FakeTransport(), None, None)
+    for chunk in chunks:
+      conn.receivedData(chunk)
+
+  def bufferNext():
+    buf = BsonReceiveBuffer(codec)
+    buf.append(stream)
+    while buf.next() is not None:
+      pass
+
+  def encode():
+    for doc in mix:
+      codec.dumps(doc)
+
+  def decode(): # then read the routing fields.
+    for bsonData in data:
+      doc = codec.loads(bsonData)
+      doc['_src'], doc['_dst'], doc.get('_ctl')
+
+  def lazyDecode():
+    for bsonData in data:
+      doc = LazyDocument(bsonData, codec)
+      doc['_src'], doc['_dst'], doc.get('_ctl')
+
+  factory = BsonNetworkFactory(Options.clientid, options)
+  factory.logging = logging
+  sink = SinkProtocol(FakeTransport(), ('localhost', 0), factory)
+  sink.clientid = 'client'
+
+  def dispatch():
+    for doc in mix:
+      sink.receivedBson(doc)
+
+  def validate():
+    for doc in mix:
+      sink.validMessage(doc)
+
+  router = BsonRouterFactory(Options.clientid, options)
+  router.logging = logging
+  dest = BsonRouterProtocol(FakeTransport(), ('localhost', 0), router)
+  dest.clientid = 'dest'
+  router.registerClient('dest', dest)
+  source = BsonRouterProtocol(FakeTransport(), ('localhost', 0), router)
+  source.clientid = 'client'
+
+  routed = docMix('dest')
+  routedData = [codec.dumps(doc) for doc in routed]
+
+  def forward():
+    for doc in routed:
+      router.forward(doc)
+
+  def fastpath():
+    for bsonData in routedData:
+      source.receivedBsonData(bsonData)
+
+  return [('framing', mix, framing), ('buffer_next', mix, bufferNext),
+    ('encode', mix, encode), ('decode', mix, decode),
+    ('lazy_decode', mix, lazyDecode), ('dispatch', mix, dispatch),
+    ('validate', mix, validate), ('router_forward', routed, forward),
+    ('router_fastpath', routed, fastpath)]
+
+
+def benchStages(iterations=20000, repeats=3):
+  '''Throughput (documents per second) of every stage, the best of
+  `repeats` runs of about `iterations` documents each. Returns [(name,
+  throughput)] in stage order.'''
+  logging.getLogger().setLevel(logging.WARNING)
+  results = []
+  for name, docs, run in stages():
+    rounds = max(1, iterations / len(docs))
+    best = None
+    for repeat in range(0, repeats):
+      tic = time.time()
+      for i in xrange(rounds):
+        run()
+      elapsed = time.time() - tic
+      best = elapsed if best is None else min(best, elapsed)
+    results.append((name, rounds * len(docs) / best))
+  return results
+
+
+def compareStages(results, baseline, threshold):
+  '''Returns the names of the stages slower than `baseline` by more than
+  `threshold` (a fraction).'''
+  return [name for name, rate in results.items() \
+    if name in baseline and rate < baseline[name] * (1 - threshold)]
+
+
+def parseOptions():
+  import optparse
+
+  usage = 'usage: %prog [options] [iterations]'
+  parser = optparse.OptionParser(usage=usage)
+  parser.add_option('-n', '--iterations', dest='iterations', type='int',
+    default=20000, help='documents (or calls) per measurement')
+  parser.add_option('-b', '--baseline', dest='baseline', metavar='PATH',
+    default=None, help='compare the stages against this baseline file')
+  parser.add_option('-s', '--save-baseline', dest='save', metavar='PATH',
+    default=None, help='save the stage results as a baseline file')
+  parser.add_option('-t', '--threshold', dest='threshold', type='float',
+    default=0.2, help='tolerated throughput drop (default: 0.2, i.e. 20%)')
+  parser.add_option('--stages-only', dest='stages_only', action='store_true',
+    default=False, help='skip the logging and codec comparisons')
+
+  options, args = parser.parse_args()
+  if args:
+    options.iterations = int(args[0])
+  return options
+
+
+def main():
+  options = parseOptions()
+  iterations = options.iterations
+
+  print '----- BsonNetwork Microbench -----'
+  ordered = benchStages(iterations)
+  results = dict(ordered)
+  baseline = {}
+  if options.baseline:
+    with open(options.baseline) as f:
+      baseline = json.load(f)
+
+  print 'hot path stages (documents per second):'
+  for name, rate in ordered:
+    line = '  %-16s %12.0f' % (name, rate)
+    if name in baseline:
+      change = results[name] / baseline[name] - 1
+      line += '  baseline %12.0f  %+6.1f%%' % (baseline[name], change * 100)
+    print line
+
+  if options.save:
+    with open(options.save, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+    print 'baseline saved to', options.save
+
+  if not options.stages_only:
+    printComparisons(iterations)
+
+  regressed = compareStages(results, baseline, options.threshold)
+  if regressed:
+    print 'REGRESSION (more than %d%% slower): %s' % \
+      (options.threshold * 100, ', '.join(sorted(regressed)))
+    sys.exit(1)
+
+
+def printComparisons(iterations):
+  print 'receivedBson at WARNING (us per message):'
+  for name, usecs in benchLogging(iterations):
+    print '  %-8s %8.2f' % (name, usecs)
+
+  print 'bson codecs (us per document, default: %s):' % \
+    bsoncodec.default_codec.name
+  print '  %-8s %-8s %8s %10s %10s' % ('codec', 'shape', 'bytes', 'encode',
+    'decode')
+  for name, shape, size, encode, decode in benchCodecs(iterations):
+    print '  %-8s %-8s %8d %10.2f %10.2f' % (name, shape, size, encode, decode)
+
+
+if __name__ == '__main__':
+  main()
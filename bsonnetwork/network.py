@@ -9,23 +9,48 @@ import logging
 import nanotime
 import gevent
 
-from base import PersistentClient
+from base import PersistentClient, YieldPolicy
 from protocol import BsonProtocol, BsonFactory
+from util.logger import Logger
+from util import bsoncodec
+from util.metrics import Registry
+from util.bsonscan import isDocumentArray
+from routing import isGroup
 
 class BsonNetworkProtocol(BsonProtocol):
-  '''BsonNetwork Protocol'''
+  '''BsonNetwork Protocol
+
+  Peers announce optional features in their identification message, e.g.
+  {'_src' : 'A', '_caps' : ['batch']}. With 'batch', many documents for the
+  same destination may travel in one envelope:
+    {'_src' : 'A', '_dst' : 'B', '_ctl' : 'batch', 'docs' : [doc, ...]}
+  Documents in a batch without their own _src / _dst take the envelope's.
+
+  Documents to a group (see routing.isGroup) come from the router to each
+  member with the group as _dst. They go to receivedGroupMessage.
+  '''
+
+  __slots__ = ('clientid', 'lastRecvTime', 'lastSendTime', 'peerCapabilities')
+
+  capabilities = ['batch']
+
+  defaults = dict(BsonProtocol.defaults, clientid=None)
 
   def __init__(self, *args, **kwargs):
     super(BsonNetworkProtocol, self).__init__(*args, **kwargs)
+    self.clientid = None
     self.lastRecvTime = None
     self.lastSendTime = None
+    self.peerCapabilities = () # shared, until the peer announces some.
 
-  def log(self, level, message):
-    if not self.factory.logging or not hasattr(self.factory.logging, level):
+  def log(self, level, message, *args):
+    '''Logs `message % args` if `level` is enabled. Formatting is deferred
+    to the logger, so disabled levels cost next to nothing.'''
+    logger = self.factory.logging
+    if not logger or not logger.isEnabled(level):
       return
 
-    logfn = getattr(self.factory.logging, level)
-    logfn('[BN] [%s] %s' % (self.clientid, message))
+    getattr(logger.logger, level)('[BN] [%s] ' + message, self.clientid, *args)
 
   def connectionMade(self):
     self.clientid = None
@@ -33,7 +58,8 @@ class BsonNetworkProtocol(BsonProtocol):
 
     # send identification message
     self.log('info', 'sending identification message')
-    self.forwardMessage({'_src' : self.factory.clientid})
+    self.forwardMessage({'_src' : self.factory.clientid, \
+      '_caps' : self.capabilities})
 
   def connectionLost(self, reason):
     self.close()
@@ -42,6 +68,14 @@ class BsonNetworkProtocol(BsonProtocol):
     self.log('info', 'connection closed')
     self.transport.loseConnection()
 
+  def sendQueueHigh(self):
+    self.log('warning', 'send queue above high watermark (%d bytes)',
+      self.transport.queue.bytes)
+
+  def sendQueueLow(self):
+    self.log('info', 'send queue below low watermark (%d bytes)',
+      self.transport.queue.bytes)
+
   def receivedMessage(self, msg):
     '''Override this to handle a packet addressed to this service.'''
     raise NotImplementedError
@@ -51,6 +85,7 @@ class BsonNetworkProtocol(BsonProtocol):
 
     if '_dst' not in msg:
       self.clientid = msg['_src']
+      self.peerCapabilities = msg.get('_caps', [])
       self.log('info', 'connection identified')
 
     response = {}
@@ -69,6 +104,24 @@ class BsonNetworkProtocol(BsonProtocol):
     '''Drop bson docs not for us by default.'''
     pass
 
+  def receivedGroupMessage(self, msg):
+    '''Handle a document to a group we are in like one to us (its _dst
+    tells them apart).'''
+    if msg.get('_ctl') == 'batch':
+      self.receivedBatch(msg)
+    else:
+      self.receivedMessage(msg)
+
+  def receivedBatch(self, batch):
+    '''Unpack a batch addressed to us into receivedMessage calls.'''
+    self.log('info', 'handling batch of %d documents', len(batch['docs']))
+    for doc in unpackBatch(batch):
+      self.receivedMessage(doc)
+
+  def acceptsBatches(self):
+    '''Whether the peer announced it can receive batch envelopes.'''
+    return 'batch' in self.peerCapabilities
+
   def receivedBson(self, doc):
     self.log('info', 'bson document received')
     self.log('debug', 'bson document received')
@@ -76,8 +129,8 @@ class BsonNetworkProtocol(BsonProtocol):
       self.log('warning', 'data discarded (invalid document)')
       return
 
-    self.log('info', 'document parsed from %s' % doc['_src'])
-    self.log('debug', 'document parsed %s' % str(doc))
+    self.log('info', 'document parsed from %s', doc['_src'])
+    self.log('debug', 'document parsed %s', doc)
     self.lastRecvTime = nanotime.nanotime.now()
 
     if '_dst' not in doc:
@@ -85,11 +138,20 @@ class BsonNetworkProtocol(BsonProtocol):
       self.receivedControlMessage(doc)
       return
 
+    if doc['_dst'] == self.factory.clientid and doc.get('_ctl') == 'batch':
+      self.receivedBatch(doc)
+      return
+
     if doc['_dst'] == self.factory.clientid and '_ctl' in doc:
       self.log('info', 'handling control message')
       self.receivedControlMessage(doc)
       return
 
+    if isGroup(doc['_dst']):
+      self.log('info', 'handling group message')
+      self.receivedGroupMessage(doc)
+      return
+
     if doc['_dst'] != self.factory.clientid:
       self.log('info', 'handling forward message')
       self.receivedForwardMessage(doc)
@@ -98,31 +160,75 @@ class BsonNetworkProtocol(BsonProtocol):
     self.receivedMessage(doc)
 
   def forwardMessage(self, doc):
+    '''Sends `doc`. Returns False if it was dropped.'''
+    self.log('info', 'sending document')
+    self.log('debug', 'sending document %s', doc)
+    try:
+      if self.sendBson(doc):
+        self.lastSendTime = nanotime.nanotime.now()
+        return True
+      self.log('warning', 'document dropped (send queue full)')
+    except Exception, e:
+      self.log('error', 'sending bson document error: %s', e)
+    return False
+
+  def forwardBsonData(self, bsonData):
+    '''Sends an already encoded document as is. Returns False if it was
+    dropped.'''
     self.log('info', 'sending document')
-    self.log('debug', 'sending document %s' % str(doc))
+    self.log('debug', 'sending document (%d bytes)', len(bsonData))
     try:
-      self.sendBson(doc)
-      self.lastSendTime = nanotime.nanotime.now()
+      if self.sendFrame(bsonData):
+        self.lastSendTime = nanotime.nanotime.now()
+        return True
+      self.log('warning', 'document dropped (send queue full)')
     except Exception, e:
-      self.log('error', 'sending bson document error: %s' % e)
+      self.log('error', 'sending bson document error: %s', e)
+    return False
 
   def sendMessage(self, doc, src=None, dst=None):
     if '_src' not in doc or src:
       doc['_src'] = src or self.factory.clientid
     if '_dst' not in doc or dst:
       doc['_dst'] = dst or self.clientid
-    self.forwardMessage(doc)
+    return self.forwardMessage(doc)
+
+  def sendMessages(self, docs, dst=None):
+    '''Sends many documents to one destination, in a single batch envelope
+    if the peer accepts them (one by one otherwise).'''
+    dst = dst or self.clientid
+    if len(docs) < 2 or not self.acceptsBatches():
+      for doc in docs:
+        self.sendMessage(doc, dst=dst)
+      return
+
+    batch = {'_src' : self.factory.clientid, '_dst' : dst, '_ctl' : 'batch', \
+      'docs' : docs}
+    if '_sec' in docs[0]:
+      batch['_sec'] = docs[0]['_sec']
+    self.forwardMessage(batch)
 
   def bsonDecodingError(self, error):
     errstr ='received bson parsing error: %s (bson data length: %d)'
-    self.log('error', errstr % (error, len(error.bsonData)))
+    self.log('error', errstr, error, len(error.bsonData))
 
-  def validMessage(self, doc):
+  def validMessage(self, doc, bsonData=None):
+    '''Checks the addressing, batch and secret of `doc`. If `doc` only holds
+    some fields, the document's `bsonData` is given to check the rest.'''
     invalid = 'bson document invalid: %s'
     if '_src' not in doc:
-      self.log('error', invalid % 'no source id.')
+      self.log('error', invalid, 'no source id.')
       return False
 
+    if doc.get('_ctl') == 'batch':
+      if bsonData is not None:
+        valid = isDocumentArray(bsonData, 'docs')
+      else:
+        valid = validBatch(doc)
+      if not valid:
+        self.log('error', invalid, 'batch without a list of documents')
+        return False
+
     # if self.clientid and doc['_src'] != self.clientid:
     #   self.log('error', invalid % 'source id mismatch (%s)' % doc['_src'])
     #   return False
@@ -132,11 +238,11 @@ class BsonNetworkProtocol(BsonProtocol):
       return True
 
     if '_sec' not in doc:
-      self.log('error', invalid % 'no secret')
+      self.log('error', invalid, 'no secret')
       return False
 
     if doc['_sec'] != opts.secret:
-      self.log('error', invalid % 'secret mismatch (%s)' % doc['_sec'])
+      self.log('error', invalid, 'secret mismatch (%s)' % doc['_sec'])
       return False
 
     return True
@@ -144,15 +250,62 @@ class BsonNetworkProtocol(BsonProtocol):
 
 
 
+def validBatch(batch):
+  '''Returns whether `batch` carries its documents as a list of dicts.'''
+  docs = batch.get('docs')
+  return isinstance(docs, list) and all(isinstance(doc, dict) for doc in docs)
+
+
+def unpackBatch(batch):
+  '''Returns the documents in `batch`, addressed (and signed, with its
+  _sec) like the envelope, whatever they say themselves: the envelope is
+  what was checked.'''
+  docs = batch['docs']
+  for doc in docs:
+    doc['_src'] = batch['_src']
+    doc['_dst'] = batch['_dst']
+    if '_sec' in batch:
+      doc['_sec'] = batch['_sec']
+  return docs
+
+
+
+
 class BsonNetworkFactory(BsonFactory):
 
+  _logging = None
+
+  def _getLogging(self):
+    return self._logging
+
+  def _setLogging(self, logger):
+    '''Accepts the logging module or a logging.Logger (wrapped so that level
+    checks are cached), a util.logger.Logger, or None to disable logging.'''
+    if logger and not isinstance(logger, Logger):
+      logger = Logger(logger) if hasattr(logger, 'getLogger') \
+        or hasattr(logger, 'isEnabledFor') else None
+    self._logging = logger or None
+
+  logging = property(_getLogging, _setLogging)
+
   def __init__(self, clientid, options):
     logging.info('Starting BsonNetwork v%s process with id %s on port %d' % \
       (__version__, clientid, options.port))
     self.clientid = clientid
     self.options = options
+    self.metrics = Registry()
     if hasattr(options, 'logging'):
       self.logging = options.logging
+    if getattr(options, 'queue_bytes', None):
+      self.queue_bytes = options.queue_bytes
+    if getattr(options, 'queue_policy', None):
+      self.queue_policy = options.queue_policy
+    if getattr(options, 'codec', None):
+      self.codec = bsoncodec.codec(options.codec)
+    limits = [(name, getattr(options, 'yield_' + name, None)) \
+      for name in ('docs', 'bytes', 'micros')]
+    self.yield_policy = YieldPolicy(**dict((name, limit) \
+      for name, limit in limits if limit is not None))
 
 
 
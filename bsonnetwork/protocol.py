@@ -8,7 +8,12 @@ import bson
 import struct
 import gevent
 
-from base import Protocol, Factory, Client
+from gevent.queue import Queue
+from base import Protocol, Factory, Client, default_yield_policy
+from util.bsonbuffer import BsonReceiveBuffer
+from util.bsoncodec import default_codec
+from util.bsonscan import LazyDocument, BsonValueError, encodeDocument
+from util.metrics import now
 
 
 
@@ -21,6 +26,48 @@ class LengthExceededError(BsonError):
 
 
 
+class DocumentStream(object):
+  '''Bounded queue of the documents a connection received, consumed by
+  iterating it (from any number of greenlets). put() blocks while it is
+  full: the reader then stops reading the socket, so the peer is pushed back
+  by TCP flow control. Iteration ends once closed and drained.'''
+
+  __slots__ = ('queue', 'closed')
+
+  end = StopIteration # marks the end, for consumers waiting on the queue.
+
+  def __init__(self, size):
+    self.queue = Queue(size)
+    self.closed = False
+
+  def __len__(self):
+    return self.queue.qsize()
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    if self.closed and self.queue.empty():
+      raise StopIteration
+    doc = self.queue.get()
+    if doc is self.end:
+      self.queue.put_nowait(doc) # for the other consumers.
+      raise StopIteration
+    return doc
+
+  def put(self, doc):
+    self.queue.put(doc)
+
+  def close(self):
+    '''No more documents: consumers stop once they took the queued ones.'''
+    if not self.closed:
+      self.closed = True
+      if not self.queue.full(): # else consumers see it when they drain it.
+        self.queue.put_nowait(self.end)
+
+
+
+
 class BsonProtocol(Protocol):
   '''
   Generic class for bson protocols.
@@ -37,77 +84,227 @@ class BsonProtocol(Protocol):
 
   @author Juan Batiz-Benet
 
-  @ivar recvd: buffer holding received data.
-  @type recvd: C{str}
+  @ivar recv_buffer: buffer holding received data (created on first read,
+                    its storage released whenever the connection idles).
+  @type recv_buffer: C{BsonReceiveBuffer}
+
+  @ivar codec: encodes and decodes documents (the factory's codec).
+  @type codec: C{util.bsoncodec.Codec}
+
+  @ivar arrival: when the data being handled was read (util.metrics.now).
+  @type arrival: C{int}
+
+  @ivar stream: received documents, in pull mode (see stream_size).
+  @type stream: C{DocumentStream}
+
+  @ivar budget: documents handled since the reader last yielded (dropped
+                while idle, as waiting for data yields).
+  @type budget: C{base.YieldBudget}
   '''
 
-  recv_buffer = ''
+  __slots__ = ('recv_buffer', 'arrival', 'codec', 'stream', 'budget')
+
+  defaults = dict(Protocol.defaults, recv_buffer=None, arrival=None,
+    codec=default_codec, stream=None, budget=None)
 
   max_bytes = 16777216 # 16 MB (current bson limit is 4, +proposed inc to 16)
+  min_bytes = 5 # the smallest document: its length and terminator.
+
+  read_size = 4096 # reads grow past this to fit a partial document,
+  max_read_size = 1048576 # up to this much per recv.
 
   length_fmt = '<i' # this may change in the future.
   length_size = struct.calcsize(length_fmt)
 
+  # False: received documents are not decoded, but passed as raw bson data
+  # (frames) to receivedFrame. See decodeFrame to decode them on demand.
+  decode_frames = True
+
+  # True: received documents are decoded as util.bsonscan.LazyDocuments,
+  # which only decode the values that are read. A value that does not decode
+  # when receivedBson reads it goes to bsonDecodingError; in pull mode, the
+  # reader gets the BsonValueError.
+  lazy_documents = False
+
+  # pull mode: instead of calling receivedBson (or receivedFrame), queue up
+  # to this many received documents (or frames) in `stream`, and stop
+  # reading while it is full. See documents() and streamWorkers().
+  stream_size = None
+
+  def __init__(self, transport, address, factory):
+    super(BsonProtocol, self).__init__(transport, address, factory)
+    self.recv_buffer = None
+    self.arrival = None
+    self.codec = getattr(factory, 'codec', None) or default_codec
+    self.stream = DocumentStream(self.stream_size) if self.stream_size \
+      else None
+
   def bsonDecodingError(self, error):
     ''' For potential error checking. '''
     pass
 
   def lengthLimitExceeded(self, length):
     '''
-    Callback invoked when a length prefix greater than max_bytes is
-    received.  The default implementation disconnects the transport.
+    Callback invoked when a length prefix greater than max_bytes (or
+    smaller than min_bytes, so never framed) is received.  The default
+    implementation disconnects the transport.
     '''
     self.transport.loseConnection()
 
   def receivedBson(self, message):
-    '''Override this to handle a message addressed to this service.'''
-    raise NotImplementedError
-
-  def sendBsonData(self, bsonData):
+    '''Override this to handle a message addressed to this service (or use
+    pull mode, where messages go to the stream).'''
+    if self.stream is None:
+      raise NotImplementedError
+    self.stream.put(message)
+
+  def receivedFrame(self, frame):
+    '''Override this, with decode_frames off, to handle raw documents (e.g.
+    to relay or store them untouched), or use pull mode.'''
+    if self.stream is None:
+      raise NotImplementedError
+    self.stream.put(frame)
+
+  def decodeFrame(self, frame):
+    '''Returns the document in bson data `frame` (a LazyDocument if
+    lazy_documents), or None if it does not decode (after reporting it to
+    bsonDecodingError).'''
+    try:
+      if self.lazy_documents:
+        return LazyDocument(frame, self.codec)
+      return self.codec.loads(frame)
+    except Exception, e:
+      self.decodingFailed(e, frame)
+      # Note: at this point, we may be off sync (warranting disconnect)
+      #       but let's attempt to keep going!
+      return None
+
+  def decodingFailed(self, error, frame):
+    '''Counts and reports (to bsonDecodingError) bson data `frame` that
+    did not decode.'''
+    if self.metrics:
+      self.metrics.decode_errors += 1
+    error.bsonData = frame
+    self.bsonDecodingError(error)
+
+  def documents(self):
+    '''Pull mode: returns an iterator over the received documents, which
+    ends when the connection closes. Several greenlets may share it.'''
+    if self.stream is None:
+      raise BsonError('not in pull mode (set stream_size)')
+    return iter(self.stream)
+
+  def streamWorkers(self, handler, count=1):
+    '''Pull mode: spawns `count` greenlets calling `handler(document)` for
+    the received documents, concurrently (so not necessarily in order).
+    Returns the greenlets; they exit when the connection closes.'''
+    def work():
+      for document in self.documents():
+        handler(document)
+    return [gevent.spawn(work) for i in range(0, count)]
+
+  def sendFrame(self, frame):
     '''
-    Send bson document to the other end of the connection.
-    This is useful if you are sending an unparsed bson doc
+    Send an encoded bson document (e.g. a received frame) to the other end
+    of the connection, as is. Raises LengthExceededError past max_bytes.
     '''
-    if len(bsonData) >= self.max_bytes:
+    if len(frame) >= self.max_bytes:
       errorStr = 'Trying to send %d bytes whereas maximum is %d'
-      raise LengthExceededError(errorStr % (len(bsonData), self.max_bytes))
+      raise LengthExceededError(errorStr % (len(frame), self.max_bytes))
 
-    self.transport.write(bsonData)
+    return self.transport.write(frame)
 
-  def sendBson(self, message):
-    '''Send a bson document to the other end of the connection.'''
-    self.sendBsonData(bson.dumps(message)) # let exceptions propagate up
+  def sendBsonData(self, bsonData):
+    '''Same as sendFrame.'''
+    return self.sendFrame(bsonData)
 
+  def sendBson(self, message):
+    '''Send a bson document (dict or LazyDocument) to the other end of the
+    connection.'''
+    # let exceptions propagate up
+    return self.sendFrame(encodeDocument(message, self.codec))
+
+
+  def readSize(self):
+    '''Returns how many bytes to read next: enough to complete a partially
+    received document (bounded by max_read_size), or read_size otherwise.'''
+    missing = self.recv_buffer.missingLength() if self.recv_buffer else 0
+    return min(max(missing, self.read_size), self.max_read_size)
+
+  def readTransport(self):
+    '''Reads straight into the receive buffer (no per-read allocation). An
+    idle connection waits for data without holding buffer storage.'''
+    buf = self.recv_buffer
+    if buf is None:
+      buf = self.recv_buffer = BsonReceiveBuffer(self.codec)
+
+    count = None
+    if not buf: # drained: if there is nothing to read yet, go idle.
+      count = buf.receive(self.transport.readIntoNow, self.readSize())
+      if count is None:
+        buf.release()
+        self.budget = None
+        self.transport.waitReadable()
+    if count is None:
+      count = buf.receive(self.transport.readInto, self.readSize())
+    if count:
+      self.arrival = now()
+      self.receivedBuffer()
+    return count
 
   def receivedData(self, received):
     '''Receive int prefixed data until full bson doc.'''
 
-    self.recv_buffer += received
-
-    while len(self.recv_buffer) >= self.length_size:
-      length ,= struct.unpack(
-        self.length_fmt, self.recv_buffer[:self.length_size])
-
-      if length > self.max_bytes:
+    if self.recv_buffer is None:
+      self.recv_buffer = BsonReceiveBuffer(self.codec)
+
+    self.recv_buffer.append(received)
+    self.arrival = now()
+    self.receivedBuffer()
+
+  def receivedBuffer(self):
+    '''Handle every full bson doc currently in the receive buffer.'''
+
+    buf = self.recv_buffer
+    metrics = self.metrics
+    budget = self.budget
+    if budget is None:
+      policy = getattr(self.transport, 'yield_policy', default_yield_policy)
+      budget = self.budget = policy.budget()
+    while True:
+      length = buf.nextLength()
+      if length > self.max_bytes or (length < self.min_bytes \
+          and len(buf) >= self.length_size):
         self.lengthLimitExceeded(length)
         return # bad news bears.
 
-      if len(self.recv_buffer) < length:
+      bsonData = buf.nextData()
+      if bsonData is None:
         break # not enough for full bson doc yet.
 
-      bsonData = self.recv_buffer[:length]
-      self.recv_buffer = self.recv_buffer[length:]
+      if metrics:
+        metrics.docs_in += 1
+      self.receivedBsonData(bsonData)
+      if budget.spend(len(bsonData)) and metrics: # a document is a unit of work
+        metrics.yields += 1
+
+  def receivedBsonData(self, bsonData):
+    '''
+    Handle an unparsed bson doc: pass it to receivedFrame as is if
+    decode_frames is off, else decode it and pass it to receivedBson.
+    '''
+    if not self.decode_frames:
+      self.receivedFrame(bsonData)
+      return
+
+    bsonDoc = self.decodeFrame(bsonData)
+    if bsonDoc is None:
+      return
 
-      try:
-        bsonDoc = bson.loads(bsonData)
-      except Exception, e:
-        e.bsonData = bsonData
-        self.bsonDecodingError(e)
-        # Note: at this point, we may be off sync (warranting disconnect)
-        #       but let's attempt to keep going!
-      else:
-        self.receivedBson(bsonDoc)
-        gevent.sleep(0) # cooperative yield. we got a document (a unit of work)
+    try:
+      self.receivedBson(bsonDoc)
+    except BsonValueError, e: # a lazy document value read by the handler.
+      self.decodingFailed(e, bsonData)
 
 
 
@@ -117,6 +314,15 @@ class BsonFactory(Factory):
 
   protocol = BsonProtocol
 
+  codec = default_codec # see util.bsoncodec.codec() to pick another one.
+
+  def transportRead(self, connection):
+    try:
+      super(BsonFactory, self).transportRead(connection)
+    finally:
+      if connection.stream is not None:
+        connection.stream.close() # whatever connectionLost does.
+
 
 
 
@@ -1,25 +1,95 @@
 #!/usr/bin/env python
 
 import logging
+import nanotime
 
-from network import BsonNetworkProtocol, BsonNetworkFactory
+from network import BsonNetworkProtocol, BsonNetworkFactory, unpackBatch
+from routing import RoutingTable
+from util.bsonscan import scanFields, encodeDocument
 
 __version__ = '0.3.0'
 
 class BsonRouterProtocol(BsonNetworkProtocol):
+  '''Router side of a client connection.
+
+  Clients join and leave groups with control messages to the router:
+    {'_src' : 'A', '_dst' : 'router', '_ctl' : 'join', 'group' : '#room'}
+    {'_src' : 'A', '_dst' : 'router', '_ctl' : 'leave', 'group' : '#room'}
+  answered with {'_ctl' : 'joinreply' (or 'leavereply'), 'group' : '#room'},
+  plus an 'error' if it failed. Group names start with '#' (clients cannot
+  identify as such). A document with a group as _dst goes to every member
+  but its sender, encoded once.
+  '''
+
+  __slots__ = ()
+
+  header_fields = ('_src', '_dst', '_ctl', '_sec')
+
+  decode_frames = False
+
+  def receivedFrame(self, bsonData):
+    '''
+    Fast path: documents for other clients are forwarded without being
+    parsed. Only the routing fields are read off the raw bytes, and the
+    original bytes are sent on. Batch envelopes are forwarded as a unit.
+    Anything else is decoded and takes the regular path.
+    '''
+    try:
+      header = scanFields(bsonData, self.header_fields)
+    except Exception, e:
+      header = None # let the regular path report it.
+
+    if not header or header.get('_ctl', 'batch') != 'batch' \
+        or '_dst' not in header or header['_dst'] == self.factory.clientid:
+      doc = self.decodeFrame(bsonData)
+      if doc is not None:
+        self.receivedBson(doc)
+      return
+
+    self.log('info', 'bson document received')
+    if not self.validMessage(header, bsonData):
+      self.log('warning', 'data discarded (invalid document)')
+      return
+
+    self.log('info', 'document parsed from %s', header['_src'])
+    self.lastRecvTime = nanotime.nanotime.now()
+
+    self.log('info', 'handling forward message')
+    self.factory.forwardBsonData(header, bsonData, self.arrival)
 
   def receivedMessage(self, msg):
-    self.log('error', 'router received message addressed to it: %s' % msg)
+    self.log('error', 'router received message addressed to it: %s', msg)
 
   def receivedControlMessage(self, msg):
     BsonNetworkProtocol.receivedControlMessage(self, msg)
     self.factory.registerClient(self.clientid, self)
+    if msg.get('_ctl') in ('join', 'leave'):
+      self.receivedMembership(msg)
+
+  def receivedMembership(self, msg):
+    '''Handles a join or leave control message.'''
+    group = msg.get('group')
+    response = {'_ctl' : msg['_ctl'] + 'reply', 'group' : group}
+    if not group or not isinstance(group, basestring):
+      response['error'] = 'no group given'
+    elif msg['_ctl'] == 'join':
+      try:
+        self.factory.joinGroup(group, self.clientid)
+      except ValueError, e:
+        response['error'] = str(e)
+    else:
+      self.factory.leaveGroup(group, self.clientid)
+
+    response['_dst'] = msg['_src']
+    self.sendMessage(response)
 
   def receivedForwardMessage(self, msg):
-    self.factory.forward(msg)
+    self.factory.forward(msg, self.arrival)
+
+  receivedGroupMessage = receivedForwardMessage # the router relays them.
 
   def close(self):
-    self.factory.removeClient(self.clientid)
+    self.factory.removeClient(self.clientid, self)
     BsonNetworkProtocol.close(self)
 
 
@@ -32,39 +102,136 @@ class BsonRouterFactory(BsonNetworkFactory):
 
   def __init__(self, *args, **kwargs):
     super(BsonRouterFactory, self).__init__(*args, **kwargs)
-    self.connections_ = {}
+    self.routes = RoutingTable(self.metrics)
+    self.workers = None # WorkerLinkFactory, when running multiple workers.
 
   def registerClient(self, clientid, conn):
 
-    if clientid in self.connections_ and self.connections_[clientid] == conn:
+    route = self.routes.get(clientid)
+    if route is not None and route.conn is conn:
       return # already connected. this is some other ctl msg.
 
-    connections_open = len(self.connections_)
+    connections_open = len(self.routes)
     if connections_open > self.options.clients:
       self.logging.error( \
-        '[router] refused connection to %s (max clients %d)' % \
-          (clientid, connections_open))
+        '[router] refused connection to %s (max clients %d)', \
+          clientid, connections_open)
       conn.close()
       return
 
-    self.logging.info('[router] client connected: %s (%d)' % \
-      (clientid, connections_open))
-    self.connections_[clientid] = conn
-
-  def removeClient(self, clientid):
-    if clientid in self.connections_:
-      del self.connections_[clientid]
-    self.logging.info('client disconnected: %s' % clientid)
+    try:
+      self.routes.add(clientid, conn, conn.metrics.queue_wait)
+    except ValueError, e:
+      self.logging.error('[router] refused connection to %s (%s)', \
+        clientid, e)
+      conn.close()
+      return
 
-  def forward(self, doc):
-    self.logging.info( \
-      '[router] forwarding document from %(_src)s to %(_dst)s' % doc)
+    self.logging.info('[router] client connected: %s (%d)', \
+      clientid, connections_open)
+    if self.workers:
+      self.workers.clientAdded(clientid)
+
+  def joinGroup(self, group, clientid):
+    '''Adds `clientid` to `group`. Raises ValueError if it cannot.'''
+    self.routes.join(group, clientid)
+    self.logging.info('[router] %s joined group %s', clientid, group)
+
+  def leaveGroup(self, group, clientid):
+    if self.routes.leave(group, clientid):
+      self.logging.info('[router] %s left group %s', clientid, group)
+
+  def removeClient(self, clientid, conn=None):
+    '''Removes the route of `clientid` (if it still goes to `conn`).'''
+    if self.routes.remove(clientid, conn) and self.workers:
+      self.workers.clientRemoved(clientid)
+    self.logging.info('client disconnected: %s', clientid)
+
+  def forward(self, doc, arrival=None):
+    self.logging.info('[router] forwarding document from %s to %s', \
+      doc['_src'], doc['_dst'])
     clientid = doc['_dst']
-    if clientid in self.connections_:
-      self.connections_[clientid].sendMessage(doc)
+    route = self.routes.route(clientid)
+    if route is not None and route.members is None:
+      sent = self.sendTo(route.conn, doc)
+      self.countRoute(route, sent, 0, arrival)
+    elif route is not None: # a group: encoded once for all members.
+      self.routeBsonData(route, doc, encodeDocument(doc, self.codec), arrival)
+    elif self.workers and \
+        self.workers.relay(clientid, encodeDocument(doc, self.codec)):
+      self.metrics.relayed += 1 # held by another worker.
     else:
-      self.logging.warning( \
-        '[router] dropped document from %(_src)s to %(_dst)s' % doc)
+      self.metrics.unrouted += 1
+      self.logging.warning('[router] dropped document from %s to %s', \
+        doc['_src'], doc['_dst'])
+
+  def countRoute(self, route, sent, size=0, arrival=None):
+    '''Counts a document sent (or dropped) on `route` (a routing.Route).'''
+    metrics = route.metrics
+    if sent:
+      metrics.docs += 1
+      metrics.bytes += size
+      if arrival:
+        self.metrics.recordResidency(metrics, arrival)
+    else:
+      metrics.drops += 1
+
+  def sendTo(self, conn, doc):
+    '''Sends `doc` on `conn`, unpacking batches the peer cannot take.
+    Returns False if (any of) it was dropped.'''
+    if doc.get('_ctl') == 'batch' and not conn.acceptsBatches():
+      sent = [conn.sendMessage(msg) for msg in unpackBatch(doc)]
+      return all(sent)
+    return conn.sendMessage(doc)
+
+  def sendBsonDataTo(self, conn, header, bsonData):
+    '''Sends an unparsed document on `conn`. Batches are only decoded (and
+    unpacked) if the peer cannot take them whole.'''
+    if header.get('_ctl') == 'batch' and not conn.acceptsBatches():
+      return self.sendTo(conn, self.codec.loads(bsonData))
+    return conn.forwardBsonData(bsonData)
+
+  def routeBsonData(self, route, header, bsonData, arrival=None):
+    '''Sends an unparsed document on `route`. For a group, the same bytes
+    are written to each member's transport, except the sender's.'''
+    if route.members is None:
+      sent = self.sendBsonDataTo(route.conn, header, bsonData)
+      self.countRoute(route, sent, len(bsonData), arrival)
+      return
+
+    src = header.get('_src')
+    for member in route.members.values():
+      if member.clientid != src:
+        sent = self.sendBsonDataTo(member.conn, header, bsonData)
+        self.countRoute(member, sent, len(bsonData), arrival)
+    self.countRoute(route, True, len(bsonData))
+
+  def forwardBsonData(self, header, bsonData, arrival=None):
+    '''Forward an unparsed document, given its routing `header` fields and
+    the time it arrived at.'''
+    self.logging.info('[router] forwarding document from %s to %s', \
+      header['_src'], header['_dst'])
+    clientid = header['_dst']
+    route = self.routes.route(clientid)
+    if route is not None:
+      self.routeBsonData(route, header, bsonData, arrival)
+    elif self.workers and self.workers.relay(clientid, bsonData):
+      self.metrics.relayed += 1 # held by another worker.
+    else:
+      self.metrics.unrouted += 1
+      self.logging.warning('[router] dropped document from %s to %s', \
+        header['_src'], header['_dst'])
+
+  def deliverBsonData(self, header, bsonData, arrival=None):
+    '''Deliver a document relayed by another worker. It is never relayed
+    again: if the client is not here (anymore), it is dropped.'''
+    route = self.routes.route(header['_dst'])
+    if route is not None:
+      self.routeBsonData(route, header, bsonData, arrival)
+    else:
+      self.metrics.unrouted += 1
+      self.logging.warning('[router] dropped document from %s to %s', \
+        header['_src'], header['_dst'])
 
 
 
@@ -86,14 +253,34 @@ def parseArgs():
   '''
 
   from util import arg_parser
+  from util.process import store_int_range
   parser = arg_parser(usage)
+
+  parser.add_option('-w', '--workers', dest='workers', metavar='NUMBER',
+    type='int', action='callback', callback=store_int_range(1, 1024),
+    default=1, help='number of router processes sharing the port (limits '
+      'like --clients apply to each)')
+
+  parser.add_option('--worker-socket-dir', dest='worker_socket_dir',
+    metavar='PATH', default=None,
+    help='directory for the unix sockets linking workers (default: tmp)')
+
   return parser.parse_args()
 
 
 def main():
   options, args = parseArgs()
 
-  fmt='[%(asctime)s][%(levelname)8s][' + options.clientid + '] %(message)s'
+  worker = 0
+  if options.workers > 1:
+    from workers import forkWorkers
+    worker = forkWorkers(options.workers)
+
+  name = options.clientid
+  if options.workers > 1:
+    name += ':%d' % worker
+
+  fmt='[%(asctime)s][%(levelname)8s][' + name + '] %(message)s'
   logging.basicConfig(level=options.logging, format=fmt)
 
   logging.info('options: %s' % options)
@@ -103,14 +290,31 @@ def main():
   factory = BsonRouterFactory(options.clientid, options)
   factory.logging = logging
 
-  if options.connect_to:
+  if options.workers > 1:
+    logging.info('Linking worker %d of %d', worker, options.workers)
+    from workers import WorkerLinkFactory
+    factory.workers = WorkerLinkFactory(factory, worker, options.workers, \
+      options.worker_socket_dir)
+    factory.workers.start()
+
+  if options.connect_to and worker == 0:
     logging.info('Starting clients')
     from base import Client
     clients = [Client.spawn(factory, addr) for addr in options.connect_to]
 
+  if options.stats_socket:
+    from util.metrics import serveStats
+    path = options.stats_socket
+    if options.workers > 1:
+      path += '.%d' % worker
+    logging.info('Serving stats on %s', path)
+    serveStats(path, factory.metrics)
+
   logging.info('Starting server')
   from base import Server
-  server = Server(('', options.port), factory)
+  server = Server(('', options.port), factory, \
+    reuse_port=(options.workers > 1), max_connections=options.clients, \
+    backlog=options.backlog, accept_rate=options.accept_rate)
   server.serve_forever()
 
 
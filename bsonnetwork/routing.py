@@ -0,0 +1,233 @@
+
+'''
+Routing table of the router.
+
+Maps addresses to routes: the connection documents for that address are
+sent on, and the counters of what was sent there (util.metrics.RouteMetrics).
+Addresses are
+  client ids -- one connection each, registered on identification.
+  prefixes   -- every address starting with the prefix goes to one client,
+                e.g. 'node2/' to the link to the router holding those.
+  groups     -- a set of member clients; documents to the group go to each.
+                Group names start with `group_prefix`, which client ids may
+                not, so a group cannot take the id of a client yet to come.
+Clients and groups share one dict, so routing a document is a single hash
+probe (prefixes are only tried when that misses). Client ids are interned
+when registered: the table, the metrics and the worker directory all share
+one string per client.
+'''
+
+from util.metrics import RouteMetrics
+
+
+group_prefix = '#'
+
+
+def isGroup(address):
+  '''Returns whether `address` is (the name of) a group.'''
+  return isinstance(address, basestring) and address.startswith(group_prefix)
+
+
+
+def internId(clientid):
+  '''Returns the canonical (interned) string for `clientid`. Lookups with
+  equal (e.g. freshly decoded unicode) ids still match it.'''
+  if isinstance(clientid, unicode):
+    try:
+      clientid = clientid.encode('ascii')
+    except UnicodeError:
+      return clientid
+  if isinstance(clientid, str):
+    return intern(clientid)
+  return clientid
+
+
+
+class Route(object):
+  '''Route to one client: its connection, and the counters of what was sent
+  on it. Also knows the groups it is in and the prefixes it takes.'''
+
+  __slots__ = ('clientid', 'conn', 'metrics', 'groups', 'prefixes')
+
+  members = None # not a group.
+
+  def __init__(self, clientid, conn, metrics):
+    self.clientid = clientid
+    self.conn = conn
+    self.metrics = metrics
+    self.groups = None # created on first join.
+    self.prefixes = None # created on first prefix.
+
+
+
+class GroupRoute(object):
+  '''Route to a group: documents go to each of its `members` (clientid ->
+  Route). `metrics` counts the documents sent to the group as a whole.'''
+
+  __slots__ = ('group', 'members', 'metrics')
+
+  conn = None # not a client.
+
+  def __init__(self, group, metrics):
+    self.group = group
+    self.members = {}
+    self.metrics = metrics
+
+
+
+class RoutingTable(object):
+  '''Routes of the clients connected to a router, their groups and
+  prefixes. Route counters are kept in `metrics` (util.metrics.Registry),
+  if given, so that they show in its dumps.'''
+
+  def __init__(self, metrics=None):
+    self.entries = {} # client id or group -> Route or GroupRoute.
+    self.prefixes = {} # prefix -> Route.
+    self.prefix_lengths = [] # longest first.
+    self.metrics = metrics
+    self.count = 0 # client routes.
+
+  def __len__(self):
+    return self.count
+
+  def routeMetrics(self, address, queue_wait=None):
+    if self.metrics is None:
+      return RouteMetrics(queue_wait)
+    self.metrics.removeRoute(address) # fresh counters for a new route.
+    return self.metrics.route(address, queue_wait)
+
+  def dropMetrics(self, address):
+    if self.metrics is not None:
+      self.metrics.removeRoute(address)
+
+  def get(self, address):
+    '''Returns the entry registered under exactly `address`, or None.'''
+    return self.entries.get(address)
+
+  def route(self, address):
+    '''Returns the Route or GroupRoute for `address`, or None.'''
+    route = self.entries.get(address)
+    if route is None and self.prefixes:
+      route = self.matchPrefix(address)
+    return route
+
+  def matchPrefix(self, address):
+    '''Returns the route of the longest prefix of `address`, or None.'''
+    if not isinstance(address, basestring):
+      return None
+    for length in self.prefix_lengths:
+      route = self.prefixes.get(address[:length])
+      if route is not None:
+        return route
+    return None
+
+  def clients(self):
+    '''Returns the ids of all routed clients.'''
+    return [address for address, route in self.entries.iteritems() \
+      if route.members is None]
+
+  def add(self, clientid, conn, queue_wait=None):
+    '''Routes `clientid` to `conn`, replacing any previous route for it (its
+    groups and prefixes carry over). Returns the new Route. Raises
+    ValueError if `clientid` is a group.'''
+    if isGroup(clientid):
+      raise ValueError('%s is a group address' % clientid)
+
+    clientid = internId(clientid)
+    old = self.entries.get(clientid)
+    if old is not None and old.members is not None:
+      raise ValueError('%s is a group address' % clientid)
+
+    route = Route(clientid, conn, self.routeMetrics(clientid, queue_wait))
+    self.entries[clientid] = route
+    if old is None:
+      self.count += 1
+      return route
+
+    route.groups = old.groups
+    for group in route.groups or ():
+      self.entries[group].members[clientid] = route
+    route.prefixes = old.prefixes
+    for prefix in route.prefixes or ():
+      self.prefixes[prefix] = route
+    return route
+
+  def remove(self, clientid, conn=None):
+    '''Removes the route of `clientid` (only if it goes to `conn`, if given)
+    with its group memberships and prefixes. Returns whether it did.'''
+    route = self.entries.get(clientid)
+    if route is None or route.members is not None:
+      return False
+    if conn is not None and route.conn is not conn:
+      return False # replaced by a newer connection.
+
+    for group in list(route.groups or ()):
+      self.leave(group, clientid)
+    for prefix in list(route.prefixes or ()):
+      self.removePrefix(prefix)
+    del self.entries[clientid]
+    self.dropMetrics(clientid)
+    self.count -= 1
+    return True
+
+  def addPrefix(self, prefix, clientid):
+    '''Routes every address starting with `prefix` (and not otherwise
+    routed) to client `clientid`.'''
+    route = self.entries.get(clientid)
+    if route is None or route.members is not None:
+      raise ValueError('%s is not a client' % clientid)
+
+    prefix = internId(prefix)
+    self.removePrefix(prefix)
+    self.prefixes[prefix] = route
+    if route.prefixes is None:
+      route.prefixes = set()
+    route.prefixes.add(prefix)
+    self.updatePrefixLengths()
+
+  def removePrefix(self, prefix):
+    route = self.prefixes.pop(prefix, None)
+    if route is not None:
+      route.prefixes.discard(prefix)
+      self.updatePrefixLengths()
+
+  def updatePrefixLengths(self):
+    lengths = set(len(prefix) for prefix in self.prefixes)
+    self.prefix_lengths = sorted(lengths, reverse=True)
+
+  def join(self, group, clientid):
+    '''Adds client `clientid` to `group` (created if needed). Returns the
+    GroupRoute. Raises ValueError if either address is of the wrong kind.'''
+    route = self.entries.get(clientid)
+    if route is None or route.members is not None:
+      raise ValueError('%s is not a client' % clientid)
+    if not isGroup(group):
+      raise ValueError('group names start with %s' % group_prefix)
+
+    group = internId(group)
+    entry = self.entries.get(group)
+    if entry is None:
+      entry = self.entries[group] = GroupRoute(group, self.routeMetrics(group))
+    elif entry.members is None:
+      raise ValueError('%s is a client address' % group)
+
+    entry.members[route.clientid] = route
+    if route.groups is None:
+      route.groups = set()
+    route.groups.add(group)
+    return entry
+
+  def leave(self, group, clientid):
+    '''Removes client `clientid` from `group`, dropping emptied groups.
+    Returns whether it was a member.'''
+    entry = self.entries.get(group)
+    if entry is None or entry.members is None \
+        or clientid not in entry.members:
+      return False
+
+    route = entry.members.pop(clientid)
+    route.groups.discard(group)
+    if not entry.members:
+      del self.entries[group]
+      self.dropMetrics(group)
+    return True
@@ -1,61 +1,116 @@
 #!/usr/bin/env python
 
+import os
 import sys
+import json
 import gevent
+import gevent.pool
 import time
 import logging
-import bson
+import bsoncodec
+import bsonbuffer
 
-from gevent import socket
+from metrics import Histogram
+from scenarios import scenarios, payloadSizes, payloadMessage
 
-try:
-  bson.patch_socket(socket.socket)
-except:
-  import bsonbuffer
-  bsonbuffer.patch_socket(socket.socket)
+from gevent import socket
+from gevent.lock import BoundedSemaphore
 
 
 
-def new_sock(addr):
-  logging.debug('opening router socket at %s:%d' % addr)
+def new_sock(addr, bind=None):
+  '''Connects to `addr`, from local address `bind` if given. Every local
+  address has its own ephemeral ports, so spreading connections over a few
+  (e.g. 127.0.0.1-127.0.0.9) allows more than ~28k of them to one router.'''
+  logging.debug('opening router socket at %s:%d', *addr)
   sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  if bind:
+    sock.bind((bind, 0))
   sock.connect(addr)
   return sock
 
 
 
 class Connection(object):
-  def __init__(self, clientid, sockaddr):
+  '''A client connection to a router.
+
+  Received bytes go into one persistent BsonReceiveBuffer, read in large
+  chunks: documents that arrive together are framed off a single recv, and
+  nothing read ahead is lost between calls. Up to `window` requests may be
+  outstanding: send() waits while that many are, and each document
+  received frees one while any are (None: no limit, e.g. for open loop
+  senders). Documents beyond the requests sent do not widen the window.
+  Iterating yields the documents received until the connection closes.
+  '''
+
+  codec = bsoncodec.default_codec # see main (--codec).
+  read_size = 32768
+
+  def __init__(self, clientid, sockaddr, bind=None, window=None):
     self.clientid = clientid
     self.sockaddr = sockaddr
     self.stats = {'sent': 0, 'recv': 0}
+    self.window = BoundedSemaphore(window) if window else None
+    self.outstanding = 0 # requests sent through the window, not answered.
+    self.buffer = bsonbuffer.BsonReceiveBuffer(self.codec)
 
-    self._socket = new_sock(sockaddr)
-    self._socket.sendobj({'_src':clientid})
-    self.remoteid = self._socket.recvobj()['_src']
+    self._socket = new_sock(sockaddr, bind)
+    self._socket.sendall(self.codec.dumps({'_src':clientid}))
+    self.remoteid = self._next()['_src']
 
-    logging.debug(self.clientid + ' connected')
+    logging.debug('%s connected', self.clientid)
 
   def send(self, msg):
+    '''Sends `msg`, first waiting for room in the window.'''
+    if self.window:
+      self.window.acquire()
+      self.outstanding += 1
     msg['_src'] = self.clientid
-    self._socket.sendobj(msg)
+    self._socket.sendall(self.codec.dumps(msg))
     self.stats['sent'] += 1
-    logging.debug(self.clientid + ' send ' + str(msg))
+    logging.debug('%s send %s', self.clientid, msg)
+
+  def _next(self):
+    '''Returns the next document, reading more only if none is buffered.
+    Raises EOFError once the connection is closed.'''
+    doc = self.buffer.next()
+    while doc is None:
+      if not self.buffer.receive(self._socket.recv_into, self.read_size):
+        raise EOFError('%s: connection closed' % self.clientid)
+      doc = self.buffer.next()
+    return doc
 
   def recv(self):
-    msg = self._socket.recvobj()
+    msg = self._next()
+    if self.outstanding:
+      self.outstanding -= 1
+      self.window.release()
     self.stats['recv'] += 1
-    logging.debug(self.clientid + ' recv ' + str(msg))
+    logging.debug('%s recv %s', self.clientid, msg)
     return msg
 
+  def __iter__(self):
+    while True:
+      try:
+        yield self.recv()
+      except EOFError:
+        return
+
+  def close(self):
+    self._socket.close()
+
 
 
 class ConnectionPair(object):
-  def __init__(self, pairid, sockaddr):
+  '''Two connections, `c1` sending to `c2`. With a `window`, c1 keeps that
+  many messages in flight, echoed back by c2 (see pipeline).'''
+
+  def __init__(self, pairid, sockaddr, bind=None, window=None):
     self.pairid = pairid
-    self.c2 = Connection(pairid + '2', sockaddr)
-    self.c1 = Connection(pairid + '1', sockaddr)
+    self.c2 = Connection(pairid + '2', sockaddr, bind)
+    self.c1 = Connection(pairid + '1', sockaddr, bind, window)
     self.stats = {'flight_time' : 0.0, 'sent' : 0}
+    self.rtt = Histogram() # microseconds
 
   def _sendMessage(self, msg, frm, to):
     tic = time.time()
@@ -66,14 +121,49 @@ class ConnectionPair(object):
 
     self.stats['flight_time'] += (toc - tic)
     self.stats['sent'] += 1
+    self.rtt.record((toc - tic) * 1e6)
 
   def sendMessage(self, msg):
     self._sendMessage(msg, self.c1, self.c2)
     self._sendMessage(msg, self.c2, self.c1)
 
+  def echo(self):
+    '''c2 sends every message it receives back to c1.'''
+    for msg in self.c2:
+      msg['_dst'] = self.c1.clientid
+      self.c2.send(msg)
+
+  def receiveEchoes(self, messages):
+    for i in xrange(messages):
+      msg = self.c1.recv()
+      rtt = time.time() - msg['_t']
+      # counted as two one way messages, like sendMessage.
+      self.stats['flight_time'] += rtt
+      self.stats['sent'] += 2
+      self.rtt.record(rtt * 1e6 / 2)
+
+  def pipeline(self, messages):
+    '''Sends `messages` from c1 to c2 and back, as many at once as the
+    window of c1 lets through.'''
+    echo = gevent.spawn(self.echo)
+    receiver = gevent.spawn(self.receiveEchoes, messages)
+    try:
+      for i in xrange(messages):
+        msg = nextMessage(self, i)
+        msg['_dst'] = self.c2.clientid
+        msg['_t'] = time.time()
+        self.c1.send(msg)
+      receiver.get()
+    finally:
+      gevent.killall([echo, receiver])
+
   def avgRTT(self):
     return self.stats['flight_time'] / self.stats['sent']
 
+  def close(self):
+    self.c1.close()
+    self.c2.close()
+
 
 
 
@@ -82,12 +172,171 @@ def nextMessage(pair, message):
   return {'herp':'derp'}
 
 
-def sendMessages(pairid, sockaddr, messages):
-  '''Replace this method to run benchmarks on other services'''
-  pair = ConnectionPair(pairid, sockaddr)
-  for i in range(0, messages):
-    pair.sendMessage(nextMessage(pair, i))
-  return pair.stats['flight_time'], pair.stats['sent']
+def sendMessages(pairid, sockaddr, messages, bind=None, window=1):
+  '''Replace this method to run benchmarks on other services. A `window`
+  over 1 pipelines the messages (ConnectionPair.pipeline) instead of
+  sending them in lockstep.'''
+  if window > 1:
+    pair = ConnectionPair(pairid, sockaddr, bind, window)
+    pair.pipeline(messages)
+  else:
+    pair = ConnectionPair(pairid, sockaddr, bind)
+    for i in xrange(messages):
+      pair.sendMessage(nextMessage(pair, i))
+  pair.close()
+  return pair.stats['flight_time'], pair.stats['sent'], pair.rtt
+
+
+
+
+
+
+class OpenLoopStats(object):
+  '''Results of one open loop run, over all its connections.'''
+
+  def __init__(self):
+    self.sent = 0
+    self.received = 0
+    self.errors = 0
+    self.latency = Histogram() # microseconds, from intended send time.
+
+  def result(self, rate, connections, elapsed):
+    return {'rate' : rate, 'connections' : connections,
+      'offered' : rate * connections, 'sent' : self.sent,
+      'received' : self.received, 'lost' : self.sent - self.received,
+      'errors' : self.errors, 'elapsed' : elapsed,
+      'throughput' : self.received / elapsed if elapsed else 0.0,
+      'latency_us' : self.latency.dump(), 'latency' : self.latency.save()}
+
+
+def dueTimes(start, rate, duration):
+  '''Yields (i, time message i is due) of an open loop schedule: `rate`
+  messages per second for `duration` seconds from `start`.'''
+  for i in xrange(int(rate * duration)):
+    yield i, start + float(i) / rate
+
+
+def openLoopSend(conn, dst, rate, start, duration, stats, message=None):
+  '''Sends to `dst` on a fixed schedule: message i is due at start + i / rate
+  and carries that intended time (_t), whether or not earlier messages got
+  through. A stalled send thus shows up as latency of the messages queued
+  behind it, instead of silently lowering the offered load.
+
+  `dst` may be a function of i, and `message` one returning message i.'''
+  message = message or nextMessage
+  for i, due in dueTimes(start, rate, duration):
+    delay = due - time.time()
+    if delay > 0:
+      gevent.sleep(delay)
+
+    msg = message(conn, i)
+    msg['_dst'] = dst(i) if callable(dst) else dst
+    msg['_t'] = due
+    try:
+      conn.send(msg)
+    except Exception, e:
+      stats.errors += 1
+      logging.error('%s send error: %s', conn.clientid, e)
+      return
+    stats.sent += 1
+
+
+def openLoopReceive(conn, stats):
+  '''Receives until killed (or closed), recording the latency of every
+  message. Messages without a send time (_t) are counted as errors.'''
+  for msg in conn:
+    sent = msg.get('_t')
+    if not isinstance(sent, (int, long, float)):
+      stats.errors += 1
+      logging.error('%s received a message without _t', conn.clientid)
+      continue
+    stats.latency.record((time.time() - sent) * 1e6)
+    stats.received += 1
+
+
+def connectPairs(sockaddr, pairids, binds=None, concurrency=100):
+  '''Connects a ConnectionPair for each of `pairids`, `concurrency` at a
+  time, round robin over local addresses `binds`. Returns the pairs.'''
+  binds = binds or [None]
+  pool = gevent.pool.Pool(concurrency)
+  jobs = [pool.spawn(ConnectionPair, pairid, sockaddr, binds[i % len(binds)]) \
+    for i, pairid in enumerate(pairids)]
+  pool.join(raise_error=True)
+  return [job.value for job in jobs]
+
+
+def runOpenLoop(sockaddr, pairids, rate, duration, drain=5.0, binds=None,
+    concurrency=100):
+  '''Runs a connection pair for each of `pairids`, each connection sending
+  `rate` messages per second to the other for `duration` seconds. Returns
+  the result dict.'''
+  stats = OpenLoopStats()
+  conns = []
+  for pair in connectPairs(sockaddr, pairids, binds, concurrency):
+    conns.append((pair.c1, pair.c2))
+    conns.append((pair.c2, pair.c1))
+
+  receivers = [gevent.spawn(openLoopReceive, c, stats) for c, d in conns]
+  start = time.time() + 0.1
+  senders = [gevent.spawn(openLoopSend, c, d.clientid, rate, start, duration, \
+    stats) for c, d in conns]
+  gevent.joinall(senders)
+
+  deadline = time.time() + drain
+  while stats.received < stats.sent and time.time() < deadline:
+    gevent.sleep(0.01)
+  elapsed = time.time() - start
+
+  gevent.killall(receivers)
+  for conn, dst in conns:
+    conn.close()
+  return stats.result(rate, len(conns), elapsed)
+
+
+def printOpenLoopResult(result):
+  latency = result['latency_us']
+  print 'rate %8.1f/s x %d  sent %8d  lost %6d  throughput %9.1f/s  ' \
+    'p50 %8.2fms  p99 %8.2fms  p999 %8.2fms' % (result['rate'], \
+    result['connections'], result['sent'], result['lost'], \
+    result['throughput'], latency['p50'] / 1e3, latency['p99'] / 1e3, \
+    latency['p999'] / 1e3)
+
+
+def runOpenLoopBenchmark(host, options):
+  '''Runs at options.rate or, with options.sweep, at increasing rates until
+  the router saturates: p99 latency above options.p99 ms, or messages lost.
+  Reports the highest throughput sustained within the p99 bound.'''
+  sockaddr = sockaddrFromHost(host)
+  rate = options.rate
+  best = None
+  results = []
+  step = 0
+  while True:
+    pairids = ['$open%d-%d-' % (step, i) for i in xrange(options.clients)]
+    args = lambda ids: (sockaddr, ids, rate, options.duration, 5.0, \
+      options.bind, options.concurrency)
+    result = runSplit(options.processes, runOpenLoop, pairids, args, \
+      mergeOpenLoopResults)
+    results.append(result)
+    printOpenLoopResult(result)
+
+    saturated = result['lost'] > 0 or result['errors'] > 0 \
+      or result['latency_us']['p99'] > options.p99 * 1e3
+    if not saturated and \
+        (not best or result['throughput'] > best['throughput']):
+      best = result
+    if saturated or not options.sweep:
+      break
+    rate *= options.sweep_factor
+    step += 1
+
+  print ''
+  if best:
+    print 'Max sustained throughput: %.1f msgs/s (p99 %.2fms <= %.2fms)' % \
+      (best['throughput'], best['latency_us']['p99'] / 1e3, options.p99)
+  else:
+    print 'Saturated at the lowest rate (p99 bound %.2fms)' % options.p99
+  return results
 
 
 def sockaddrFromHost(host):
@@ -97,58 +346,251 @@ def sockaddrFromHost(host):
   return tuple(sockaddr)
 
 
-def runBenchmark(host, options):
-  '''Run benchmarks for this host.'''
-  from gevent import queue
-
+def runScenario(sockaddr, scenario, rate, duration, payload=0, drain=5.0,
+    binds=None, concurrency=100):
+  '''Runs `scenario` (util.scenarios): every sender sends `rate` messages
+  per second, with a `payload` bytes payload, for `duration` seconds.
+  Returns the open loop result dict, with the scenario and payload.'''
+  stats = OpenLoopStats()
+  binds = binds or [None]
+  senders = scenario.senders()
+  clientids = senders + [c for c in scenario.receivers() if c not in senders]
+
+  pool = gevent.pool.Pool(concurrency)
+  jobs = [pool.spawn(Connection, clientid, sockaddr, binds[i % len(binds)]) \
+    for i, clientid in enumerate(clientids)]
+  pool.join(raise_error=True)
+  conns = dict((job.value.clientid, job.value) for job in jobs)
+
+  template = payloadMessage(payload)
+  message = lambda conn, i: dict(template)
+  route = lambda sender: lambda i: scenario.destination(sender, i)
+
+  receivers = [gevent.spawn(openLoopReceive, conns[c], stats) \
+    for c in scenario.receivers()]
+  start = time.time() + 0.1
+  senders = [gevent.spawn(openLoopSend, conns[c], route(c), rate, start, \
+    duration, stats, message) for c in senders]
+  gevent.joinall(senders)
+
+  deadline = time.time() + drain
+  while stats.received < stats.sent and time.time() < deadline:
+    gevent.sleep(0.01)
+  elapsed = time.time() - start
+
+  gevent.killall(receivers)
+  for conn in conns.values():
+    conn.close()
+
+  result = stats.result(rate, len(conns), elapsed)
+  result['offered'] = rate * len(scenario.senders())
+  result['scenario'] = scenario.name
+  result['payload'] = payload
+  return result
+
+
+def runScenarioBenchmark(host, options):
+  '''Runs options.scenario, once per payload size for 'payload' (pairs
+  with payloads from 50 bytes to the 16MB document limit). With several
+  processes, each runs its own copy of the scenario.'''
   sockaddr = sockaddrFromHost(host)
+  name = 'pairs' if options.scenario == 'payload' else options.scenario
+  sizes = payloadSizes() if options.scenario == 'payload' \
+    else [options.payload]
 
-  print 'setting up worker queue...'
+  results = []
+  for step, size in enumerate(sizes):
+    # large payloads are sent at a lower rate, to offer at most byte_rate.
+    rate = options.rate
+    if size and options.byte_rate:
+      rate = min(rate, float(options.byte_rate) / size)
+
+    prefixes = ['$%s%d-%d-' % (name, step, i) for i in range(options.processes)]
+    args = lambda prefixes: (sockaddr, scenarios[name](prefixes[0], \
+      options.clients), rate, options.duration, size, 5.0 + size / 1e6, \
+      options.bind, options.concurrency)
+    result = runSplit(options.processes, runScenario, prefixes, args, \
+      mergeOpenLoopResults)
+    print '%-8s payload %9d  ' % (name, size),
+    printOpenLoopResult(result)
+    results.append(result)
+  return results
+
+
+def writeResults(path, options, results):
+  '''Writes `results` and the options that produced them as json.'''
+  report = {'time' : time.time(), 'label' : options.label,
+    'options' : dict((k, v) for k, v in vars(options).items() \
+      if isinstance(v, (int, long, float, str, list, type(None)))),
+    'results' : results}
+  with open(path, 'w') as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+
+
+def mergeOpenLoopResults(results):
+  '''Combines the open loop results of concurrent runs into one.'''
+  merged = dict(results[0])
+  latency = Histogram.load(results[0]['latency'])
+  for result in results[1:]:
+    for key in ('connections', 'offered', 'sent', 'received', 'lost', 'errors'):
+      merged[key] += result[key]
+    merged['elapsed'] = max(merged['elapsed'], result['elapsed'])
+    latency.merge(Histogram.load(result['latency']))
+
+  elapsed = merged['elapsed']
+  merged['throughput'] = merged['received'] / elapsed if elapsed else 0.0
+  merged['latency_us'] = latency.dump()
+  merged['latency'] = latency.save()
+  return merged
+
+
+def runClosedLoop(sockaddr, pairids, messages, concurrency, binds=None,
+    progress=False, window=1):
+  '''Runs every pair in `pairids` (`concurrency` at a time), sending
+  `messages` ping pongs each, `window` at a time. Returns the result dict.'''
+  from gevent import queue
+
+  binds = binds or [None]
   in_queue = queue.JoinableQueue()
   results = []
+  errors = []
 
   def print_progress():
-    print '\rpairs left to finish:', options.clients - len(results),
-    sys.stdout.flush()
-
-  def work():
-    nextid = in_queue.get()
-    result = sendMessages(nextid, sockaddr, options.messages)
+    if progress:
+      print '\rpairs left to finish:', len(pairids) - len(results),
+      sys.stdout.flush()
+
+  def work(job):
+    index, nextid = job
+    bind = binds[index % len(binds)]
+    try:
+      result = sendMessages(nextid, sockaddr, messages, bind, window)
+    except Exception, e:
+      logging.error('%s error: %s', nextid, e)
+      errors.append(e)
+      result = (0.0, 0, Histogram())
     results.append(result)
     print_progress()
 
   def worker():
     logging.debug('greenlet initialized')
     while True:
+      job = in_queue.get()
       try:
-        work()
+        work(job)
       finally:
         in_queue.task_done()
 
-  for i in range(options.concurrency):
-     gevent.spawn(worker)
-     #FIXME(jbenet): are these spawned greenlets actually deallocated?
+  workers = [gevent.spawn(worker) for i in range(concurrency)]
 
-  print 'setting up jobs...'
-  for i in range(options.clients):
-    in_queue.put('$tester-%d-' % i)
+  for job in enumerate(pairids):
+    in_queue.put(job)
 
-  print 'running...'
-  print ''
   print_progress()
-
   tic = time.time()
   in_queue.join()  # block until all tasks are done
   toc = time.time()
-  print '\rdone.                             '
+  gevent.killall(workers)
+
+  rtt = Histogram()
+  for result in results:
+    rtt.merge(result[2])
+  return {'pairs' : len(pairids), 'sent' : sum(r[1] for r in results),
+    'flight_time' : sum(r[0] for r in results), 'errors' : len(errors),
+    'elapsed' : toc - tic, 'rtt_us' : rtt.dump(), 'rtt' : rtt.save()}
+
+
+def mergeClosedLoopResults(results):
+  '''Combines the closed loop results of concurrent runs into one.'''
+  merged = dict(results[0])
+  rtt = Histogram.load(results[0]['rtt'])
+  for result in results[1:]:
+    for key in ('pairs', 'sent', 'flight_time', 'errors'):
+      merged[key] += result[key]
+    merged['elapsed'] = max(merged['elapsed'], result['elapsed'])
+    rtt.merge(Histogram.load(result['rtt']))
+  merged['rtt_us'] = rtt.dump()
+  merged['rtt'] = rtt.save()
+  return merged
+
+
+def runSplit(processes, function, pairids, args, merge):
+  '''Runs function(*args(ids)) over `pairids` split in `processes` forked
+  processes (or in this one, if 1), and returns merge(results).'''
+  if processes <= 1:
+    return function(*args(pairids))
+
+  children = []
+  for index in range(processes):
+    ids = pairids[index::processes]
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      os.close(read)
+      gevent.reinit()
+      raiseFileLimit()
+      try:
+        result = function(*args(ids))
+      except Exception, e:
+        logging.error('bench process %d failed: %s', index, e)
+        os._exit(1)
+      with os.fdopen(write, 'w') as pipe:
+        pipe.write(json.dumps(result))
+      os._exit(0)
+
+    os.close(write)
+    children.append((pid, read))
 
-  tup = reduce(lambda a, b: (a[0] + b[0], a[1] + b[1]), results)
-  avgrtt = tup[0] / tup[1]
+  results = []
+  for pid, read in children:
+    with os.fdopen(read) as pipe:
+      data = pipe.read()
+    os.waitpid(pid, 0)
+    if data:
+      results.append(json.loads(data))
+
+  if not results:
+    raise RuntimeError('all bench processes failed')
+  return merge(results)
+
+
+def raiseFileLimit():
+  '''Raises the open files limit as far as allowed. Returns the limit.'''
+  import resource
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if hard == resource.RLIM_INFINITY:
+    hard = 1048576
+  try:
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+  except (ValueError, resource.error), e:
+    logging.warning('could not raise open files limit: %s', e)
+  return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def runBenchmark(host, options):
+  '''Run benchmarks for this host.'''
+  sockaddr = sockaddrFromHost(host)
+  pairids = ['$tester-%d-' % i for i in xrange(options.clients)]
+  args = lambda ids: (sockaddr, ids, options.messages, options.concurrency, \
+    options.bind, options.processes == 1, options.window)
+
+  print 'running...'
+  print ''
+  result = runSplit(options.processes, runClosedLoop, pairids, args, \
+    mergeClosedLoopResults)
+  print '\rdone.                             '
 
+  rtt = result['rtt_us']
   print ''
-  print 'Messages Sent:', tup[1]
-  print 'Average RTT:', avgrtt
-  print 'Running Time:', (toc - tic)
+  print 'Messages Sent:', result['sent']
+  print 'Errors:', result['errors']
+  if result['sent']:
+    print 'Average RTT:', result['flight_time'] / result['sent']
+    print 'RTT p50/p99/p999 (ms): %.2f / %.2f / %.2f' % (rtt['p50'] / 1e3, \
+      rtt['p99'] / 1e3, rtt['p999'] / 1e3)
+  print 'Running Time:', result['elapsed']
+  print 'Throughput: %.1f msgs/s' % (result['sent'] / result['elapsed'])
+  return result
 
 
 
@@ -172,15 +614,53 @@ def parseOptions():
     default=1, help='number of benchmark connections to make')
   parser.add_option('-m', '--messages', dest='messages', metavar='INTEGER',
     default=1, help='number of messages to send per connection')
+  parser.add_option('-W', '--window', dest='window', metavar='INTEGER',
+    default=1, help='closed loop: messages in flight per pair (pipelined, '
+      'echoed back) instead of one ping pong at a time')
+  parser.add_option('-P', '--processes', dest='processes', metavar='INTEGER',
+    default=1, help='number of processes to spread connections over')
+  parser.add_option('-b', '--bind', dest='bind', metavar='ADDR[,ADDR...]',
+    default=None, help='local addresses to connect from (round robin), '
+      'e.g. 127.0.0.1,127.0.0.2 for more connections than ephemeral ports')
+  parser.add_option('-r', '--rate', dest='rate', metavar='FLOAT',
+    type='float', default=None, help='open loop: messages per second sent '
+      'by every connection, whatever the replies (default: closed loop)')
+  parser.add_option('-d', '--duration', dest='duration', metavar='SECONDS',
+    type='float', default=10.0, help='open loop: seconds per run')
+  parser.add_option('--sweep', dest='sweep', action='store_true',
+    default=False, help='open loop: raise the rate until saturation')
+  parser.add_option('--sweep-factor', dest='sweep_factor', metavar='FLOAT',
+    type='float', default=1.5, help='open loop: rate multiplier per step')
+  parser.add_option('--p99', dest='p99', metavar='MS', type='float',
+    default=10.0, help='open loop: p99 latency bound, in milliseconds')
+  parser.add_option('--scenario', dest='scenario', type='choice',
+    choices=sorted(scenarios.keys()) + ['payload'], default=None,
+    help='open loop traffic pattern: %s, or payload (pairs, sweeping '
+      'payload sizes up to 16MB)' % ', '.join(sorted(scenarios.keys())))
+  parser.add_option('--payload', dest='payload', metavar='BYTES', type='int',
+    default=0, help='scenario payload size in bytes (default: tiny doc)')
+  parser.add_option('--byte-rate', dest='byte_rate', metavar='BYTES',
+    type='int', default=50 * 1024 * 1024,
+    help='scenario: max bytes per second per sender (lowers the rate)')
+  parser.add_option('--json', dest='json', metavar='PATH', default=None,
+    help='write the results as json to PATH')
+  parser.add_option('--label', dest='label', metavar='STRING', default='',
+    help='label stored with --json results (e.g. the router version)')
+  parser.add_option('--codec', dest='codec', type='choice',
+    choices=bsoncodec.available(), default=bsoncodec.default_codec.name,
+    help='bson codec. one of %s' % bsoncodec.available())
   parser.add_option('-l', '--logging', dest='logging', metavar='loglevel',
     default='INFO', help='one of %s' % str(loglevels.keys()))
 
   options, args = parser.parse_args()
 
   clipi = lambda n, minimum, maximum: max(min(int(n), maximum), minimum)
-  options.concurrency = clipi(options.concurrency, 1, 1000)
-  options.messages = clipi(options.messages, 0, 1000)
-  options.clients = clipi(options.clients, 0, 10000)
+  options.concurrency = clipi(options.concurrency, 1, 100000)
+  options.messages = clipi(options.messages, 0, 10 ** 9)
+  options.clients = clipi(options.clients, 0, 10 ** 7)
+  options.processes = clipi(options.processes, 1, 1024)
+  options.window = clipi(options.window, 1, 10 ** 6)
+  options.bind = options.bind.split(',') if options.bind else None
 
   options.logging = options.logging.upper()
   if options.logging not in loglevels:
@@ -206,15 +686,33 @@ def main():
 
   fmt='[%(asctime)s][%(levelname)8s] %(message)s'
   logging.basicConfig(level=options.logging, format=fmt)
+  Connection.codec = bsoncodec.codec(options.codec)
 
   print '----- BsonRouter Bench -----'
   print 'Host:', args[0]
+  print 'Codec:', options.codec
+  print 'Processes:', options.processes
+  print 'Open Files Limit:', raiseFileLimit()
   print 'Concurrency:', options.concurrency
   print 'Connection Sets:', options.clients
-  print 'Messages Per Pair:', options.messages
-  print 'Total Messages:', options.messages * options.clients * 2
 
-  runBenchmark(args[0], options)
+  if options.scenario:
+    options.rate = options.rate or 100.0
+    print 'Scenario:', options.scenario
+    print 'Open Loop Rate:', options.rate, 'msgs/s per sender'
+    results = runScenarioBenchmark(args[0], options)
+  elif options.rate:
+    print 'Open Loop Rate:', options.rate, 'msgs/s per connection'
+    results = runOpenLoopBenchmark(args[0], options)
+  else:
+    print 'Messages Per Pair:', options.messages
+    print 'Window:', options.window
+    print 'Total Messages:', options.messages * options.clients * 2
+    results = [runBenchmark(args[0], options)]
+
+  if options.json:
+    writeResults(options.json, options, results)
+    print 'Results written to', options.json
 
 if __name__ == '__main__':
   main()
\ No newline at end of file
@@ -1,8 +1,9 @@
 
 
-import bson
 import struct
 
+from bsoncodec import default_codec
+
 
 
 class BsonException(Exception):
@@ -16,75 +17,157 @@ class BsonDecodeError(BsonException):
 
 
 
+empty_buffer = bytearray() # shared storage of all empty buffers.
+
+
+
 class BsonReceiveBuffer(object):
-  '''Buffer to receive BSON documents.'''
+  '''Buffer to receive BSON documents.
 
-  __slots__ = ('buffer')
+  Received bytes live in a single bytearray with a read offset (`start`) and
+  a write offset (`end`). Taking a document off the front only advances
+  `start`; the unread tail is moved back to the front only when an append
+  does not fit, so framing many documents costs O(bytes), not
+  O(bytes * documents). Empty buffers share `empty_buffer` until their first
+  write, so idle buffers cost no storage.
+
+  Documents are decoded with `codec` (default: bsoncodec.default_codec).
+  '''
+
+  __slots__ = ('buffer', 'start', 'end', 'codec')
 
   len_fmt = '<i'
   len_size = struct.calcsize(len_fmt)
   max_bytes = 2 ** (8 * len_size)
 
-  def __init__(self):
-    self.buffer = ''
+  min_capacity = 4096 # first allocation, avoids tiny regrowths.
+  idle_capacity = 65536 # larger buffers are released once drained.
+
+  def __init__(self, codec=None):
+    self.codec = codec or default_codec
+    self.buffer = empty_buffer
+    self.start = 0
+    self.end = 0
+
+  def __len__(self):
+    return self.end - self.start
 
   def nextLength(self):
     '''Returns the length of the next document.'''
-    if len(self.buffer) < self.len_size:
+    if self.end - self.start < self.len_size:
       return 0
 
-    length ,= struct.unpack(self.len_fmt, self.buffer[:self.len_size])
+    length ,= struct.unpack_from(self.len_fmt, self.buffer, self.start)
     if length > self.max_bytes:
       raise BsonLengthExceeded('max bson length %d exceeded' % self.max_bytes)
     return length
 
   def missingLength(self):
     '''Returns the number of bytes missing from the next document.'''
-    missing = self.nextLength() - len(self.buffer)
+    missing = self.nextLength() - len(self)
     return missing if missing > 0 else 0
 
   def hasNext(self):
     '''Return wether this receiver buffer has a next element.'''
     length = self.nextLength()
-    return length > self.len_size and length <= len(self.buffer)
+    return length > self.len_size and length <= len(self)
 
-  def next(self):
-    '''Returns the next element or None if one is not available yet.'''
+  def nextData(self):
+    '''Returns the next raw bson document or None if not available yet.'''
     length = self.nextLength()
-    if length is 0 or len(self.buffer) < length:
+    if length <= self.len_size or self.end - self.start < length:
       return None
 
-    bsonData = self.buffer[:length]
-    self.buffer = self.buffer[length:]
+    start = self.start
+    self.start += length
+    bsonData = memoryview(self.buffer)[start:self.start].tobytes()
+
+    if self.start == self.end:
+      self.clear()
+    return bsonData
+
+  def next(self):
+    '''Returns the next element or None if one is not available yet.'''
+    bsonData = self.nextData()
+    if bsonData is None:
+      return None
 
     try:
-      bsonDoc = bson.loads(bsonData)
+      bsonDoc = self.codec.loads(bsonData)
     except Exception, e:
       raise
       raise BsonDecodeError
     return bsonDoc
 
+  def clear(self):
+    '''Drops all buffered data, releasing oversized storage.'''
+    self.start = 0
+    self.end = 0
+    if len(self.buffer) > self.idle_capacity:
+      self.buffer = empty_buffer
+
+  def release(self):
+    '''Releases the storage of a drained buffer (e.g. while idle).'''
+    if self.start == self.end:
+      self.clear()
+      self.buffer = empty_buffer
+
+  def reserve(self, size):
+    '''Ensures `size` bytes can be written at the write offset.'''
+    capacity = len(self.buffer)
+    if self.end + size <= capacity:
+      return
+
+    used = self.end - self.start
+    if used + size <= capacity:
+      # enough room overall: compact the unread tail to the front.
+      self.buffer[:used] = self.buffer[self.start:self.end]
+    else:
+      capacity = max(capacity * 2, used + size, self.min_capacity)
+      buffer = bytearray(capacity)
+      buffer[:used] = self.buffer[self.start:self.end]
+      self.buffer = buffer
+
+    self.start = 0
+    self.end = used
+
+  def receive(self, recv_into, size):
+    '''Reads up to `size` bytes straight into the buffer through `recv_into`
+    (e.g. socket.recv_into). Returns the number of bytes read (whatever
+    `recv_into` returns).'''
+    self.reserve(size)
+    view = memoryview(self.buffer)[self.end:self.end + size]
+    count = recv_into(view, size)
+    del view # release the export before the buffer may be resized.
+    if count:
+      self.end += count
+    return count
+
   def append(self, string):
-    self.buffer += string
+    size = len(string)
+    self.reserve(size)
+    self.buffer[self.end:self.end + size] = string
+    self.end += size
 
 
 
 
 def _sendobj(self, obj):
   '''Send a bson object from socket `self`.'''
-  self.sendall(bson.dumps(obj))
+  self.sendall(self.bson_codec.dumps(obj))
 
 def _recvobj(self):
   '''Receive the next bson object from the socket `self`'''
-  buf = BsonReceiveBuffer()
+  buf = BsonReceiveBuffer(self.bson_codec)
   buf.append(self.recv(buf.len_size))
   while not buf.hasNext():
     bytes = min(4096, buf.missingLength())
     buf.append(self.recv(bytes))
   return buf.next()
 
-def patch_socket(socket):
+def patch_socket(socket, codec=None):
   '''Setup the methods here to be available on `socket` class'''
+  socket.bson_codec = codec or default_codec
   socket.recvobj = _recvobj
   socket.sendobj = _sendobj
 
@@ -0,0 +1,99 @@
+
+'''
+BSON codecs.
+
+Both the pure python `bson` package and pymongo install a module named
+`bson`, with different APIs. Codecs wrap whichever is installed behind the
+same `dumps` / `loads` interface, and `default_codec` is the fastest one
+available (pymongo's C extension, when present).
+'''
+
+import bson
+
+
+
+class Codec(object):
+  '''Encodes documents to bson strings and decodes them back.'''
+
+  name = None
+
+  @classmethod
+  def available(cls):
+    '''Returns whether this codec can be used here.'''
+    return False
+
+  def dumps(self, doc):
+    raise NotImplementedError
+
+  def loads(self, data):
+    raise NotImplementedError
+
+  def __repr__(self):
+    return '<%s codec>' % self.name
+
+
+
+class PyBsonCodec(Codec):
+  '''The pure python `bson` package.'''
+
+  name = 'bson'
+
+  @classmethod
+  def available(cls):
+    return hasattr(bson, 'dumps') and hasattr(bson, 'loads')
+
+  def __init__(self):
+    self.dumps = bson.dumps
+    self.loads = bson.loads
+
+
+
+class PymongoCodec(Codec):
+  '''pymongo's `bson` module (C accelerated if built with its extension).'''
+
+  name = 'pymongo'
+
+  @classmethod
+  def available(cls):
+    return hasattr(bson, 'BSON') and hasattr(bson.BSON, 'encode')
+
+  @classmethod
+  def accelerated(cls):
+    return cls.available() and hasattr(bson, 'has_c') and bson.has_c()
+
+  def __init__(self):
+    self.dumps = bson.BSON.encode
+    self.decode = getattr(bson, 'decode', None) # pymongo >= 3.9
+
+  def loads(self, data):
+    if self.decode:
+      return self.decode(data)
+    return bson.BSON(data).decode()
+
+
+
+codecs = dict((c.name, c) for c in (PyBsonCodec, PymongoCodec))
+
+
+def codec(name):
+  '''Returns a new instance of the codec called `name`.'''
+  if name not in codecs or not codecs[name].available():
+    raise ValueError('bson codec %s not available' % name)
+  return codecs[name]()
+
+
+def available():
+  '''Returns the names of the codecs that can be used here.'''
+  return [name for name, c in codecs.items() if c.available()]
+
+
+def fastest():
+  '''Returns an instance of the fastest available codec.'''
+  if PymongoCodec.accelerated():
+    return PymongoCodec()
+  if PyBsonCodec.available():
+    return PyBsonCodec()
+  return PymongoCodec()
+
+
+default_codec = fastest()
@@ -0,0 +1,311 @@
+
+import struct
+
+from bsoncodec import default_codec
+
+
+
+class BsonScanError(Exception):
+  pass
+
+
+
+class BsonValueError(BsonScanError):
+  '''A value of a LazyDocument that does not decode (found on reading it).'''
+  pass
+
+
+
+# element type -> size of fixed width values.
+fixed_sizes = {
+  '\x01' : 8,  # double
+  '\x06' : 0,  # undefined
+  '\x07' : 12, # objectid
+  '\x08' : 1,  # boolean
+  '\x09' : 8,  # utc datetime
+  '\x0A' : 0,  # null
+  '\x10' : 4,  # int32
+  '\x11' : 8,  # timestamp
+  '\x12' : 8,  # int64
+  '\x13' : 16, # decimal128
+  '\xFF' : 0,  # min key
+  '\x7F' : 0,  # max key
+}
+
+# element types whose value is an int32 length followed by that many bytes.
+string_types = ('\x02', '\x0D', '\x0E')
+
+# element types whose value starts with its own int32 total length.
+document_types = ('\x03', '\x04', '\x0F')
+
+# smallest valid length prefix of the variable length types.
+min_lengths = {
+  '\x02' : 1,  # string: at least its null terminator
+  '\x0D' : 1,  # javascript code
+  '\x0E' : 1,  # symbol
+  '\x03' : 5,  # document: length and terminator
+  '\x04' : 5,  # array
+  '\x0F' : 14, # code with scope: length, string, document
+  '\x05' : 0,  # binary
+  '\x0C' : 1,  # dbpointer string
+}
+
+int32 = struct.Struct('<i')
+
+
+
+def cstringEnd(data, start):
+  '''Returns the offset of the null terminating the cstring at `start`.'''
+  try:
+    return data.index('\x00', start)
+  except ValueError:
+    raise BsonScanError('unterminated bson cstring')
+
+
+def valueLength(data, etype, start):
+  '''Returns the int32 length prefix of the value at `start`. Raises
+  BsonScanError if it is too small to be valid (e.g. negative).'''
+  try:
+    length = int32.unpack_from(data, start)[0]
+  except struct.error:
+    raise BsonScanError('bson element overruns document')
+  if length < min_lengths[etype]:
+    raise BsonScanError('invalid bson element length %d' % length)
+  return length
+
+
+def valueEnd(data, etype, start):
+  '''Returns the offset right after the value of type `etype` at `start`.'''
+  if etype in fixed_sizes:
+    return start + fixed_sizes[etype]
+
+  if etype in string_types:
+    return start + 4 + valueLength(data, etype, start)
+
+  if etype in document_types:
+    return start + valueLength(data, etype, start)
+
+  if etype == '\x05': # binary: length, subtype, bytes
+    return start + 5 + valueLength(data, etype, start)
+
+  if etype == '\x0B': # regex: two cstrings
+    return cstringEnd(data, cstringEnd(data, start) + 1) + 1
+
+  if etype == '\x0C': # dbpointer: string, objectid
+    return start + 4 + valueLength(data, etype, start) + 12
+
+  raise BsonScanError('unknown bson element type 0x%02x' % ord(etype))
+
+
+def decodeValue(data, etype, start, end, codec=default_codec):
+  '''Decodes a single element value found by `elements`.'''
+  if etype == '\x02':
+    return data[start + 4:end - 1].decode('utf-8')
+
+  # wrap the value in a one element document and let bson decode it.
+  value = data[start:end]
+  doc = int32.pack(len(value) + 7) + etype + '\x00' + value + '\x00'
+  return codec.loads(doc)[u'']
+
+
+def elements(data):
+  '''Yields (name, type, start, end) for every top-level element of the raw
+  bson document `data`, where data[start:end] holds the encoded value.'''
+  try:
+    length = int32.unpack_from(data, 0)[0]
+  except struct.error:
+    raise BsonScanError('malformed bson document (length %d)' % len(data))
+  if length != len(data) or data[-1] != '\x00':
+    raise BsonScanError('malformed bson document (length %d)' % len(data))
+
+  pos = 4
+  last = length - 1
+  while pos < last:
+    etype = data[pos]
+    name_end = cstringEnd(data, pos + 1)
+    start = name_end + 1
+    end = valueEnd(data, etype, start)
+    if end > last:
+      raise BsonScanError('bson element overruns document')
+    if end <= pos:
+      raise BsonScanError('bson element does not advance') # never loop.
+    yield data[pos + 1:name_end], etype, start, end
+    pos = end
+
+
+def scanFields(data, fields):
+  '''Returns a dict with the top-level `fields` present in raw bson document
+  `data`, decoding only those values. Stops as soon as all are found.'''
+  found = {}
+  for name, etype, start, end in elements(data):
+    if name in fields:
+      found[name] = decodeValue(data, etype, start, end)
+      if len(found) == len(fields):
+        break
+  return found
+
+
+def isDocumentArray(data, name):
+  '''Returns whether top-level field `name` of raw bson document `data` is
+  an array of documents, reading only the element types. Malformed data is
+  not.'''
+  try:
+    for field, etype, start, end in elements(data):
+      if field == name:
+        return etype == '\x04' and all(itype == '\x03' \
+          for item, itype, istart, iend in elements(data[start:end]))
+  except BsonScanError:
+    pass
+  return False
+
+
+
+
+class LazyDocument(object):
+  '''Dict-like view of a raw bson document that decodes values on demand.
+
+  The top-level elements are indexed in one pass over the bytes, and each
+  value is decoded the first time it is read (nested documents and arrays
+  whole, as plain dicts and lists). Changing the document first decodes
+  all of it, and from then on it works on a plain dict. encode() returns
+  the original bytes while the document is unchanged, and no nested dict
+  or list was handed out (which may since have been changed in place).
+
+  A value that does not decode raises BsonValueError when read.
+
+  Codecs only encode real dicts: documents holding a LazyDocument must
+  convert it (dict(lazy)) first.
+  '''
+
+  __slots__ = ('data', 'index', 'decoded', 'codec', 'exposed')
+
+  def __init__(self, data, codec=default_codec):
+    self.data = data # None once changed.
+    self.codec = codec
+    self.exposed = False # a nested dict or list was handed out.
+    self.decoded = {}
+    self.index = {} # name -> (type, start, end), while unchanged.
+    for name, etype, start, end in elements(data):
+      self.index[name.decode('utf-8')] = (etype, start, end)
+
+  def __getitem__(self, key):
+    value = self.value(key)
+    if isinstance(value, (dict, list)):
+      self.exposed = True
+    return value
+
+  def value(self, key):
+    '''Returns the value of `key`, decoding it if needed.'''
+    try:
+      return self.decoded[key]
+    except KeyError:
+      if self.index is None:
+        raise
+    etype, start, end = self.index[key]
+    try:
+      value = decodeValue(self.data, etype, start, end, self.codec)
+    except Exception, e:
+      raise BsonValueError('cannot decode value of %r: %s' % (key, e))
+    self.decoded[key] = value
+    return value
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def __contains__(self, key):
+    return key in (self.decoded if self.index is None else self.index)
+
+  has_key = __contains__
+
+  def __len__(self):
+    return len(self.decoded if self.index is None else self.index)
+
+  def keys(self):
+    return (self.decoded if self.index is None else self.index).keys()
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  iterkeys = __iter__
+
+  def values(self):
+    return [self[key] for key in self.keys()]
+
+  def items(self):
+    return [(key, self[key]) for key in self.keys()]
+
+  def itervalues(self):
+    return iter(self.values())
+
+  def iteritems(self):
+    return iter(self.items())
+
+  def decodeAll(self):
+    '''Decodes every value not read yet. Returns the dict holding them.'''
+    if self.index is not None and len(self.decoded) < len(self.index):
+      for key in self.index:
+        if key not in self.decoded:
+          self.value(key)
+    return self.decoded
+
+  def dict(self):
+    '''Returns the document as a plain dict, which it works on from then on:
+    changes to either show in both.'''
+    self.decodeAll()
+    self.index = None
+    self.data = None
+    return self.decoded
+
+  def copy(self):
+    self.exposed = True # shallow: shares the nested values.
+    return dict(self.decodeAll())
+
+  def encode(self, codec=None):
+    '''Returns the document as bson data: as received, if unchanged.'''
+    if self.data is not None and not self.exposed:
+      return self.data
+    return (codec or self.codec).dumps(self.decodeAll())
+
+  def __setitem__(self, key, value):
+    self.dict()[key] = value
+
+  def __delitem__(self, key):
+    del self.dict()[key]
+
+  def pop(self, key, *default):
+    return self.dict().pop(key, *default)
+
+  def popitem(self):
+    return self.dict().popitem()
+
+  def setdefault(self, key, default=None):
+    return self.dict().setdefault(key, default)
+
+  def update(self, *args, **kwargs):
+    self.dict().update(*args, **kwargs)
+
+  def clear(self):
+    self.dict().clear()
+
+  def __eq__(self, other):
+    if isinstance(other, LazyDocument):
+      other = other.decodeAll()
+    return self.decodeAll() == other
+
+  def __ne__(self, other):
+    return not self == other
+
+  __hash__ = None
+
+  def __repr__(self):
+    return 'LazyDocument(%r)' % self.decodeAll()
+
+
+def encodeDocument(doc, codec=default_codec):
+  '''Returns `doc` (a dict or LazyDocument) encoded by `codec`.'''
+  if isinstance(doc, LazyDocument):
+    return doc.encode(codec)
+  return codec.dumps(doc)
@@ -0,0 +1,66 @@
+
+import logging
+
+
+
+class Logger(object):
+  '''
+  Wrapper around a logging.Logger (or the logging module itself, meaning the
+  root logger) for use on per-message paths.
+
+  Which levels are enabled is cached, so a disabled call costs a few
+  attribute lookups. Messages take logging-style arguments, which are only
+  formatted if a record is actually emitted.
+
+  The cache is refreshed whenever the logger's own level or logging.disable
+  change. Call refresh() after changing the level of an ancestor logger.
+  '''
+
+  __slots__ = ('logger', 'enabled', 'level', 'disabled')
+
+  levels = {'debug': logging.DEBUG,
+            'info': logging.INFO,
+            'warning': logging.WARNING,
+            'error': logging.ERROR,
+            'critical': logging.CRITICAL}
+
+  def __init__(self, logger=logging):
+    if logger is logging:
+      logger = logging.getLogger()
+    self.logger = logger
+    self.refresh()
+
+  def refresh(self):
+    '''Recompute which levels are enabled.'''
+    logger = self.logger
+    self.level = logger.level
+    self.disabled = logger.manager.disable
+    self.enabled = {}
+    for name, level in self.levels.items():
+      self.enabled[name] = logger.isEnabledFor(level)
+
+  def isEnabled(self, level):
+    '''Returns whether messages at `level` (a level name) are emitted.'''
+    logger = self.logger
+    if logger.level != self.level or logger.manager.disable != self.disabled:
+      self.refresh()
+    return self.enabled.get(level, False)
+
+  def log(self, level, message, *args):
+    if self.isEnabled(level):
+      getattr(self.logger, level)(message, *args)
+
+  def debug(self, message, *args):
+    self.log('debug', message, *args)
+
+  def info(self, message, *args):
+    self.log('info', message, *args)
+
+  def warning(self, message, *args):
+    self.log('warning', message, *args)
+
+  def error(self, message, *args):
+    self.log('error', message, *args)
+
+  def critical(self, message, *args):
+    self.log('critical', message, *args)
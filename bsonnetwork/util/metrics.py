@@ -0,0 +1,265 @@
+
+'''
+Cheap live counters.
+
+Every connection carries a ConnectionMetrics (plain slot attributes,
+incremented in place on the hot paths), the router keeps a RouteMetrics per
+registered client, and a factory's Registry dumps them all on demand, as
+json to whoever connects to the stats socket (see serveStats). The dump
+holds every client's id and address, so it is not served to clients.
+'''
+
+import os
+import json
+import time
+import array
+import nanotime
+
+
+
+def text(value):
+  '''Returns `value` as a string fit for a dump key (ids may be unicode).'''
+  return value if isinstance(value, basestring) else str(value)
+
+
+
+def now():
+  '''Current time in (integer) nanoseconds, the unit of all timestamps.'''
+  return int(nanotime.nanotime.now())
+
+
+
+class Histogram(object):
+  '''Log-linear (HDR style) histogram of non-negative integers, e.g.
+  latencies in microseconds.
+
+  Values below 2 * sub_buckets are counted exactly. Above that, every power
+  of two range is split into `sub_buckets` equal buckets, so any value is
+  known within 1 / sub_buckets (~6%) whatever its magnitude. Bucket storage
+  only grows up to the largest value recorded, and values are clamped to
+  `max_value`, so memory stays bounded.
+  '''
+
+  __slots__ = ('counts', 'count', 'total', 'max')
+
+  sub_bits = 4
+  sub_buckets = 2 ** sub_bits
+  max_value = 2 ** 36 # ~19 hours, in microseconds.
+
+  def __init__(self):
+    self.counts = array.array('L')
+    self.count = 0
+    self.total = 0
+    self.max = 0
+
+  @classmethod
+  def bucketIndex(cls, value):
+    if value < 2 * cls.sub_buckets:
+      return value
+    shift = value.bit_length() - cls.sub_bits - 1
+    return (shift << cls.sub_bits) + (value >> shift)
+
+  @classmethod
+  def bucketHigh(cls, index):
+    '''Returns the highest value counted in bucket `index`.'''
+    if index < 2 * cls.sub_buckets:
+      return index
+    shift = (index >> cls.sub_bits) - 1
+    return ((index - (shift << cls.sub_bits) + 1) << shift) - 1
+
+  def record(self, value):
+    value = min(max(int(value), 0), self.max_value)
+    index = self.bucketIndex(value)
+    counts = self.counts
+    if index >= len(counts):
+      counts.extend([0] * (index + 1 - len(counts)))
+    counts[index] += 1
+    self.count += 1
+    self.total += value
+    if value > self.max:
+      self.max = value
+
+  def merge(self, other):
+    '''Adds the counts of histogram `other` to this one.'''
+    counts = self.counts
+    if len(other.counts) > len(counts):
+      counts.extend([0] * (len(other.counts) - len(counts)))
+    for index, count in enumerate(other.counts):
+      counts[index] += count
+    self.count += other.count
+    self.total += other.total
+    self.max = max(self.max, other.max)
+
+  def save(self):
+    '''Returns the state of this histogram as plain (json, bson) data.'''
+    return {'counts' : list(self.counts), 'count' : self.count,
+      'total' : self.total, 'max' : self.max}
+
+  @classmethod
+  def load(cls, state):
+    '''Returns a histogram with a state returned by save().'''
+    hist = cls()
+    hist.counts.extend(state['counts'])
+    hist.count = state['count']
+    hist.total = state['total']
+    hist.max = state['max']
+    return hist
+
+  def percentile(self, percent):
+    '''Returns the `percent` percentile (within the bucket precision).'''
+    if not self.count:
+      return 0
+
+    rank = self.count * percent / 100.0
+    seen = 0
+    for index, count in enumerate(self.counts):
+      seen += count
+      if seen >= rank:
+        return min(self.bucketHigh(index), self.max)
+    return self.max
+
+  def dump(self):
+    mean = float(self.total) / self.count if self.count else 0.0
+    return {'count' : self.count, 'mean' : mean, 'max' : self.max,
+      'p50' : self.percentile(50), 'p99' : self.percentile(99),
+      'p999' : self.percentile(99.9)}
+
+
+
+class ConnectionMetrics(object):
+  '''Counters of one connection, shared by its Transport and Protocol.'''
+
+  __slots__ = ('bytes_in', 'bytes_out', 'docs_in', 'docs_out', 'sends',
+               'decode_errors', 'drops', 'queue_peak', 'yields',
+               'send_latency', 'queue_wait')
+
+  counters = __slots__[:-2]
+
+  def __init__(self):
+    for name in self.counters:
+      setattr(self, name, 0)
+    self.send_latency = Histogram() # microseconds per socket send.
+    self.queue_wait = Histogram() # microseconds from write to sent.
+
+  def dump(self):
+    stats = dict((name, getattr(self, name)) for name in self.counters)
+    stats['send_latency'] = self.send_latency.dump()
+    stats['queue_wait'] = self.queue_wait.dump()
+    return stats
+
+
+
+class RouteMetrics(object):
+  '''Counters of documents routed to one destination. `residency` is the
+  time documents spent in the router, from arrival to being queued, and
+  `queue_wait` the time they then spent in the destination's send queue
+  (the histogram of that connection's metrics).'''
+
+  __slots__ = ('docs', 'bytes', 'drops', 'residency', 'queue_wait')
+
+  def __init__(self, queue_wait=None):
+    self.docs = 0
+    self.bytes = 0
+    self.drops = 0
+    self.residency = Histogram()
+    self.queue_wait = queue_wait or Histogram()
+
+  def dump(self):
+    return {'docs' : self.docs, 'bytes' : self.bytes, 'drops' : self.drops,
+      'residency' : self.residency.dump(),
+      'queue_wait' : self.queue_wait.dump()}
+
+
+
+class Registry(object):
+  '''The metrics of a factory: its live connections, routes, and totals
+  (like documents the router had no route for). Global latencies and the
+  yield count cover closed connections and routes too. `yields_per_sec` is
+  averaged over the registry's `uptime`; the rate over an interval is the
+  difference of two dumps.'''
+
+  def __init__(self):
+    self.started = time.time()
+    self.connections = set()
+    self.routes = {}
+    self.unrouted = 0
+    self.relayed = 0
+    self.residency = Histogram()
+    self.queue_wait = Histogram() # of closed connections.
+    self.yields = 0 # of closed connections.
+
+  def connectionAdded(self, conn):
+    self.connections.add(conn)
+
+  def connectionRemoved(self, conn):
+    if conn in self.connections:
+      self.connections.remove(conn)
+      self.queue_wait.merge(conn.metrics.queue_wait)
+      self.yields += conn.metrics.yields
+
+  def route(self, clientid, queue_wait=None):
+    '''Returns the RouteMetrics of `clientid`, creating it if needed (with
+    the `queue_wait` histogram of its connection).'''
+    route = self.routes.get(clientid)
+    if route is None:
+      route = self.routes[clientid] = RouteMetrics(queue_wait)
+    return route
+
+  def recordResidency(self, route, arrival):
+    '''Records the residency of a document that arrived at `arrival` (ns),
+    and was just queued for `route`.'''
+    micros = (now() - arrival) / 1000
+    route.residency.record(micros)
+    self.residency.record(micros)
+
+  def removeRoute(self, clientid):
+    self.routes.pop(clientid, None)
+
+  def dumpConnection(self, conn):
+    stats = conn.metrics.dump()
+    stats['client'] = text(getattr(conn, 'clientid', None) or '')
+    stats['address'] = text(conn.address)
+    queue = getattr(conn.transport, 'queue', None)
+    stats['queue_bytes'] = queue.bytes if queue else 0
+    stats['queue_docs'] = len(queue) if queue else 0
+    return stats
+
+  def dump(self):
+    routes = dict((text(clientid), route.dump()) \
+      for clientid, route in self.routes.items())
+    queue_wait = Histogram()
+    queue_wait.merge(self.queue_wait)
+    yields = self.yields
+    for conn in self.connections:
+      queue_wait.merge(conn.metrics.queue_wait)
+      yields += conn.metrics.yields
+    uptime = time.time() - self.started
+
+    return {'connections' : [self.dumpConnection(c) for c in self.connections],
+      'routes' : routes, 'unrouted' : self.unrouted, 'relayed' : self.relayed,
+      'residency' : self.residency.dump(), 'queue_wait' : queue_wait.dump(),
+      'uptime' : uptime, 'yields' : yields,
+      'yields_per_sec' : yields / uptime if uptime > 0 else 0.0}
+
+
+
+def serveStats(path, registry):
+  '''Serves `registry` on unix socket `path`: every connection gets one json
+  dump, then is closed. Returns the (started) gevent server.'''
+  from gevent import socket
+  from gevent.server import StreamServer
+
+  if os.path.exists(path):
+    os.unlink(path)
+
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  listener.bind(path)
+  listener.listen(8)
+
+  def handler(sock, address):
+    sock.sendall(json.dumps(registry.dump()))
+    sock.close()
+
+  server = StreamServer(listener, handler)
+  server.start()
+  return server
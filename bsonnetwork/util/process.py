@@ -5,6 +5,8 @@ import logging
 import optparse
 from optparse import OptionValueError
 
+import bsoncodec
+
 
 
 def randomPort(low=10000, high=65000):
@@ -31,6 +33,22 @@ def store_int_range(min, max):
   return store_int
 
 
+def store_float_range(min, max):
+  '''Returns an optparse store callback that validates a float within a range'''
+  def store_float(option, ops, value, parser):
+    if value is None:
+      return
+
+    value = float(value)
+    if value > max:
+      raise OptionValueError('value for %s too large (max: %g)' % (ops, max))
+    if value < min:
+      raise OptionValueError('value for %s too small (min: %g)' % (ops, min))
+    setattr(parser.values, option.dest, value)
+
+  return store_float
+
+
 
 def store_loglevel(option, ops, value, parser):
   '''optparse store callback that validates loglevel'''
@@ -114,6 +132,53 @@ def arg_parser(usage, **defaults):
   parser.add_option('-i', '--client-id', dest='clientid', metavar='STRING',
     default=defaults['clientid'], help='bsonnetwork client id')
 
+  parser.add_option('--backlog', dest='backlog', metavar='NUMBER',
+    type='int', action='callback', callback=store_int_range(1, 65535),
+    default=defaults.get('backlog'),
+    help='listen backlog: connections waiting to be accepted')
+
+  parser.add_option('--accept-rate', dest='accept_rate', metavar='PER_SEC',
+    type='float', action='callback', callback=store_float_range(0.01, 1e9),
+    default=defaults.get('accept_rate'),
+    help='maximum new connections accepted per second')
+
+  parser.add_option('--queue-bytes', dest='queue_bytes', metavar='BYTES',
+    type='int', action='callback', callback=store_int_range(1, 2 ** 31 - 1),
+    default=defaults.get('queue_bytes'),
+    help='maximum bytes queued for sending, per connection')
+
+  parser.add_option('--queue-policy', dest='queue_policy', type='choice',
+    choices=['block', 'drop-newest', 'drop-oldest', 'disconnect'],
+    default=defaults.get('queue_policy'),
+    help='what to do with sends to a full queue. one of (block, '
+      'drop-newest, drop-oldest, disconnect)')
+
+  parser.add_option('--yield-docs', dest='yield_docs', metavar='NUMBER',
+    type='int', action='callback', callback=store_int_range(0, 2 ** 31 - 1),
+    default=defaults.get('yield_docs'),
+    help='connections let others run after this many documents (0: no '
+      'limit; 1: after each)')
+
+  parser.add_option('--yield-bytes', dest='yield_bytes', metavar='BYTES',
+    type='int', action='callback', callback=store_int_range(0, 2 ** 31 - 1),
+    default=defaults.get('yield_bytes'),
+    help='connections let others run after this many bytes (0: no limit)')
+
+  parser.add_option('--yield-micros', dest='yield_micros', metavar='MICROS',
+    type='int', action='callback', callback=store_int_range(0, 2 ** 31 - 1),
+    default=defaults.get('yield_micros'),
+    help='connections let others run after working this many microseconds '
+      '(0: no limit)')
+
+  parser.add_option('--stats-socket', dest='stats_socket', metavar='PATH',
+    default=defaults.get('stats_socket'),
+    help='unix socket serving a json dump of the live metrics')
+
+  parser.add_option('--codec', dest='codec', type='choice',
+    choices=bsoncodec.available(), default=defaults.get('codec'),
+    help='bson codec. one of %s (default: the fastest, %s)' % \
+      (bsoncodec.available(), bsoncodec.default_codec.name))
+
   parser.add_option('--connect-to', dest='connect_to',
     metavar='hostname:port[,hostname:port...]',
     action='callback', callback=store_hostlist, type='string',
@@ -0,0 +1,53 @@
+'''
+Random bson documents, as sent by the tests and the codec benchmark.
+
+Every generator takes the `rng` to draw from (default: the random module),
+e.g. a seeded random.Random for the same documents on every run.
+'''
+
+import random
+
+
+
+def random_object(rng=random):
+  fns = [random_dict, \
+         random_list, \
+         random_int, random_int, random_int, \
+         random_int, random_int, random_int, \
+         random_float, random_float, random_float, \
+         random_string, random_string]
+  return rng.choice(fns)(rng)
+
+def random_dict(rng=random):
+  def random_key():
+    key = ''
+    for i in range(0, 10):
+      key += chr(rng.randint(ord('A'), ord('Z')))
+    return key
+
+  elems = rng.randint(1, 7)
+  dictionary = {}
+  for r in range(0, elems):
+    dictionary[random_key()] = random_object(rng)
+  return dictionary
+
+def random_list(rng=random):
+  elems = rng.randint(1, 7)
+  seq = []
+  for r in range(0, elems):
+    seq.append(random_object(rng))
+  return seq
+
+def random_string(rng=random):
+  length = rng.randint(1, 256)
+
+  string = ''
+  for i in range(0, length):
+    string += chr(rng.randint(1, 126))
+  return string
+
+def random_int(rng=random):
+  return rng.randint(0, 10000)
+
+def random_float(rng=random):
+  return rng.random()
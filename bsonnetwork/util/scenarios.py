@@ -0,0 +1,126 @@
+
+'''
+Traffic scenarios for the router bench (bench.py --scenario).
+
+A scenario names the clients of a run, which of them send, and where each
+message goes. Every sending client sends at the open loop rate; receivers
+only receive.
+'''
+
+import random
+
+
+
+class Scenario(object):
+  '''Base scenario. `clients` is the number of clients it is sized by.'''
+
+  name = None
+
+  def __init__(self, prefix, clients):
+    self.prefix = prefix
+    self.clients = max(int(clients), 2)
+
+  def clientid(self, name):
+    return '%s%s' % (self.prefix, name)
+
+  def senders(self):
+    raise NotImplementedError
+
+  def receivers(self):
+    raise NotImplementedError
+
+  def destination(self, sender, index):
+    '''Returns the destination of message `index` from `sender`.'''
+    raise NotImplementedError
+
+
+
+class Pairs(Scenario):
+  '''Clients in pairs, each sending to the other (the classic bench).'''
+
+  name = 'pairs'
+
+  def senders(self):
+    return [self.clientid(i) for i in range(self.clients / 2 * 2)]
+
+  def receivers(self):
+    return self.senders()
+
+  def destination(self, sender, index):
+    number = int(sender[len(self.prefix):])
+    return self.clientid(number ^ 1)
+
+
+
+class FanIn(Scenario):
+  '''Every client sends to a single hot destination.'''
+
+  name = 'fanin'
+
+  def senders(self):
+    return [self.clientid(i) for i in range(self.clients - 1)]
+
+  def receivers(self):
+    return [self.clientid('hot')]
+
+  def destination(self, sender, index):
+    return self.clientid('hot')
+
+
+
+class FanOut(Scenario):
+  '''A single client sends to all others, round robin.'''
+
+  name = 'fanout'
+
+  def senders(self):
+    return [self.clientid('source')]
+
+  def receivers(self):
+    return [self.clientid(i) for i in range(self.clients - 1)]
+
+  def destination(self, sender, index):
+    return self.clientid(index % (self.clients - 1))
+
+
+
+class AllToAll(Scenario):
+  '''Every client sends to uniformly random other clients.'''
+
+  name = 'alltoall'
+
+  def senders(self):
+    return [self.clientid(i) for i in range(self.clients)]
+
+  def receivers(self):
+    return self.senders()
+
+  def destination(self, sender, index):
+    number = int(sender[len(self.prefix):])
+    other = random.randrange(self.clients - 1)
+    return self.clientid(other if other < number else other + 1)
+
+
+
+scenarios = dict((s.name, s) for s in (Pairs, FanIn, FanOut, AllToAll))
+
+
+def payloadSizes(max_bytes=16777216, smallest=50, factor=4):
+  '''Payload sizes from `smallest` up to the largest that still fits in a
+  `max_bytes` document, growing by `factor`.'''
+  largest = max_bytes - 128 # room for the fields around the payload.
+  if largest < smallest:
+    raise ValueError('max_bytes %d leaves no room for a payload' % max_bytes)
+  sizes = []
+  size = smallest
+  while size < largest:
+    sizes.append(size)
+    size *= factor
+  return sizes + [largest]
+
+
+def payloadMessage(size):
+  '''Returns a message with a `size` bytes payload (no payload if 0).'''
+  if not size:
+    return {'herp' : 'derp'}
+  return {'data' : 'x' * size}
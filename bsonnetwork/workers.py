@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+'''
+Multi-process router support.
+
+Worker processes each accept on the router port (SO_REUSEPORT), and are
+linked to each other over unix sockets. Every worker keeps a directory of
+which worker holds which client, kept up to date by the others, so a
+document for a client held elsewhere is relayed (as raw bytes) over the
+link to that worker, which delivers it locally.
+
+The directory is only eventually consistent, and nothing is acknowledged:
+  - a document for a client whose registration has not reached this
+    worker yet is dropped as unrouted (clients should wait a moment, or
+    for an answer, after connecting before expecting to be reachable).
+  - a client id registered on two workers at once is detected when the
+    other worker's 'add' arrives: the newer registration wins, as it does
+    on a single worker. If both arrive crossed, both routes are dropped.
+  - limits like --clients apply to each worker, not to the whole router.
+'''
+
+import os
+import sys
+import errno
+import signal
+import gevent
+import logging
+import tempfile
+
+from gevent import socket
+
+from base import Server, PersistentClient
+from protocol import BsonProtocol, BsonFactory
+from util.bsonscan import scanFields
+
+
+
+class WorkerLinkProtocol(BsonProtocol):
+  '''Connection between two workers of the same router.
+
+  Link control documents carry a `_wkr` field:
+    {'_wkr': 'hello', 'worker': index, 'clients': [clientid, ...]}
+    {'_wkr': 'add', 'clients': [clientid, ...]}
+    {'_wkr': 'remove', 'clients': [clientid, ...]}
+  Anything else is a client document relayed for local delivery.
+  '''
+
+  __slots__ = ('worker', )
+
+  header_fields = ('_wkr', '_src', '_dst', '_ctl')
+
+  decode_frames = False
+
+  def connectionMade(self):
+    self.worker = None
+    self.sendBson({'_wkr' : 'hello', 'worker' : self.factory.index, \
+      'clients' : self.factory.localClients()})
+
+  def connectionLost(self, reason):
+    self.factory.linkLost(self)
+
+  def receivedFrame(self, bsonData):
+    try:
+      header = scanFields(bsonData, self.header_fields)
+    except Exception, e: # malformed: drop it, keep the link.
+      if self.metrics:
+        self.metrics.decode_errors += 1
+      e.bsonData = bsonData
+      self.bsonDecodingError(e)
+      return
+
+    if '_wkr' in header:
+      doc = self.decodeFrame(bsonData)
+      if doc is not None:
+        self.receivedBson(doc)
+    else:
+      self.factory.router.deliverBsonData(header, bsonData, self.arrival)
+
+  def receivedBson(self, doc):
+    if doc['_wkr'] == 'hello':
+      self.worker = doc['worker']
+      self.factory.linkMade(self)
+      self.factory.clientsAdded(self.worker, doc['clients'])
+    elif doc['_wkr'] == 'add':
+      self.factory.clientsAdded(self.worker, doc['clients'])
+    elif doc['_wkr'] == 'remove':
+      self.factory.clientsRemoved(self.worker, doc['clients'])
+
+  def bsonDecodingError(self, error):
+    self.factory.logging.error('[workers] link bson parsing error: %s', error)
+
+
+
+
+
+class WorkerLinkClient(PersistentClient):
+  reconnect_delay = 0.1 # peers may not be listening yet.
+
+  @classmethod
+  def configured_socket(cls, family, type):
+    return socket.socket(family, type)
+
+
+
+
+
+class WorkerLinkFactory(BsonFactory):
+  '''Links a router worker to its sibling workers.
+
+  @ivar directory: clientid -> index of the worker holding that client.
+  @ivar links: worker index -> link (WorkerLinkProtocol) to that worker.
+  '''
+
+  protocol = WorkerLinkProtocol
+
+  def __init__(self, router, index, count, socket_dir=None):
+    self.router = router
+    self.logging = router.logging
+    self.codec = router.codec
+    self.index = index
+    self.count = count
+    self.socket_dir = socket_dir or tempfile.gettempdir()
+    self.directory = {}
+    self.links = {}
+    self.server = None
+    self.clients = []
+
+  def socketPath(self, index):
+    name = 'bsonrouter-%d-%d.sock' % (self.router.options.port, index)
+    return os.path.join(self.socket_dir, name)
+
+  def start(self):
+    '''Listen for higher numbered workers, connect to lower numbered ones.'''
+    path = self.socketPath(self.index)
+    if os.path.exists(path):
+      os.unlink(path)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(self.count)
+    self.server = Server(listener, self)
+    self.server.serve()
+
+    for index in range(0, self.index):
+      address = self.socketPath(index)
+      client = WorkerLinkClient.spawn(self, address, socket.AF_UNIX)
+      self.clients.append(client)
+
+  def error(self, error):
+    self.logging.warning('[workers] link error: %s', error)
+
+  def localClients(self):
+    return self.router.routes.clients()
+
+  def linkMade(self, link):
+    self.logging.info('[workers] linked to worker %d', link.worker)
+    self.links[link.worker] = link
+
+  def linkLost(self, link):
+    if link.worker is None or self.links.get(link.worker) is not link:
+      return
+
+    self.logging.warning('[workers] lost link to worker %d', link.worker)
+    del self.links[link.worker]
+    for clientid, index in self.directory.items():
+      if index == link.worker:
+        del self.directory[clientid]
+
+  def clientsAdded(self, index, clients):
+    routes = self.router.routes
+    for clientid in clients:
+      route = routes.get(clientid)
+      if route is not None and route.members is None:
+        self.logging.warning('[workers] %s registered again on worker %d, '
+          'dropping the local route', clientid, index)
+        self.router.removeClient(clientid)
+      if self.directory.get(clientid) != index:
+        self.directory[clientid] = index
+        self.logging.info('[workers] worker %d holds client %s', index,
+          clientid)
+
+  def clientsRemoved(self, index, clients):
+    for clientid in clients:
+      if self.directory.get(clientid) == index: # may have moved since.
+        del self.directory[clientid]
+
+  def broadcast(self, doc):
+    for link in self.links.values():
+      link.sendBson(doc)
+
+  def clientAdded(self, clientid):
+    '''A client registered with this worker.'''
+    self.directory.pop(clientid, None)
+    self.broadcast({'_wkr' : 'add', 'clients' : [clientid]})
+
+  def clientRemoved(self, clientid):
+    '''A client disconnected from this worker.'''
+    self.broadcast({'_wkr' : 'remove', 'clients' : [clientid]})
+
+  def relay(self, clientid, bsonData):
+    '''Sends a document to the worker holding `clientid`. Returns False if
+    no other worker is known to hold it.'''
+    link = self.links.get(self.directory.get(clientid))
+    if not link:
+      return False
+    return link.sendFrame(bsonData)
+
+
+
+
+
+def forkWorkers(count):
+  '''
+  Forks `count` worker processes and returns the worker index (in each
+  worker). The parent only supervises: it waits for the workers, and
+  terminates them when it is itself terminated. Workers exit when the
+  parent goes away.
+  '''
+
+  children = []
+  for index in range(0, count):
+    pid = os.fork()
+    if pid == 0:
+      gevent.reinit()
+      gevent.spawn(_watchParent, os.getppid())
+      return index
+    children.append(pid)
+
+  def terminate(signum, frame):
+    for pid in children:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except OSError:
+        pass
+    os._exit(0)
+
+  signal.signal(signal.SIGTERM, terminate)
+  signal.signal(signal.SIGINT, terminate)
+
+  while children:
+    try:
+      pid, status = os.wait()
+    except OSError, e:
+      if e.errno == errno.EINTR:
+        continue
+      break
+    children.remove(pid)
+    logging.warning('[workers] worker process %d exited (%d)', pid, status)
+
+  sys.exit(0)
+
+
+def _watchParent(ppid):
+  while os.getppid() == ppid:
+    gevent.sleep(1)
+  os._exit(0)
@@ -1,9 +1,28 @@
 
+import os
+import gc
+import json
+import tempfile
+import struct
+import bson
+import gevent
+import gevent.socket
+import logging
 import unittest
 import random
 import utils
 
+from bsonnetwork.util import arg_parser
 from bsonnetwork.util.test import BsonNetworkProcess as BNProcess
+from bsonnetwork.util.bench import raiseFileLimit, Connection, ConnectionPair
+from bsonnetwork.base import Server, Transport, Client
+from bsonnetwork.router import BsonRouterFactory, BsonRouterProtocol
+from bsonnetwork.network import unpackBatch, BsonNetworkFactory
+from bsonnetwork.network import BsonNetworkProtocol
+from bsonnetwork.workers import WorkerLinkFactory, WorkerLinkProtocol
+from bsonnetwork.routing import RoutingTable, internId
+from bsonnetwork.util.metrics import Registry
+from bsonnetwork.util.bsonscan import BsonScanError, elements, isDocumentArray
 
 class TestRouter(unittest.TestCase):
 
@@ -85,6 +104,439 @@ class TestRouter(unittest.TestCase):
       r.disconnect('A')
       r.disconnect('B')
 
+  def test_send_batch(self):
+    with BNProcess('python bsonnetwork/router.py -i router') as r:
+      r.connect('A')
+      r.identify('A')
+      r.connect('B')
+      r.waitForOutput('sending identification message')
+      r._recvobj('B', {})
+      r._sendobj('B', {'_src' : 'B', '_caps' : ['batch']})
+      r.waitForOutput('[B] connection identified')
+
+      # B accepts batches: the envelope is forwarded whole.
+      seq = [utils.random_dict() for i in range(0, 5)]
+      batch = {'_src' : 'A', '_dst' : 'B', '_ctl' : 'batch', 'docs' : seq}
+      r.send_and_receive('A', 'B', batch)
+
+      # A does not: the router unpacks the batch into separate documents.
+      seq = [utils.random_dict() for i in range(0, 5)]
+      r.send({'_src' : 'B', '_dst' : 'A', '_ctl' : 'batch', 'docs' : seq})
+      for doc in seq:
+        doc['_src'] = 'B'
+        doc['_dst'] = 'A'
+      r.receive(seq)
+
+      r.disconnect('A')
+      r.disconnect('B')
+
+  def test_batch_checks(self):
+    options, args = arg_parser('').parse_args(['-i', 'router', '-l', 'warning'])
+    factory = BsonRouterFactory(options.clientid, options)
+    factory.logging = logging
+    a, b = gevent.socket.socketpair()
+    conn = BsonRouterProtocol(Transport(a), ('127.0.0.1', 0), factory)
+    conn.clientid = 'A'
+
+    # inner documents cannot claim another sender.
+    batch = {'_src' : 'A', '_dst' : 'B', '_ctl' : 'batch',
+      'docs' : [{'_src' : 'C', 'x' : 1}, {'_dst' : 'D'}]}
+    self.assertTrue(conn.validMessage(batch))
+    self.assertTrue(conn.validMessage(batch, bson.dumps(batch)))
+    for doc in unpackBatch(batch):
+      self.assertEqual((doc['_src'], doc['_dst']), ('A', 'B'))
+
+    # with a secret, the envelope carries it for its documents.
+    factory.options.secret = 'sesame'
+    batch = {'_src' : 'A', '_dst' : 'B', '_ctl' : 'batch', '_sec' : 'sesame',
+      'docs' : [{'x' : 1}, {'_sec' : 'wrong'}]}
+    self.assertTrue(conn.validMessage(batch))
+    for doc in unpackBatch(batch):
+      self.assertTrue(conn.validMessage(doc))
+    factory.options.secret = None
+
+    # batches without a list of documents are rejected, not raised on.
+    for docs in [None, 'docs', [1, 2], [{'x' : 1}, 'y']]:
+      bad = {'_src' : 'A', '_dst' : 'B', '_ctl' : 'batch'}
+      if docs is not None:
+        bad['docs'] = docs
+      self.assertFalse(conn.validMessage(bad))
+      self.assertFalse(conn.validMessage(bad, bson.dumps(bad)))
+      conn.receivedFrame(bson.dumps(bad))
+      bad['_dst'] = 'router'
+      conn.receivedFrame(bson.dumps(bad))
+    self.assertEqual(factory.metrics.unrouted, 0)
+    self.assertTrue(conn.transport.connected)
+
+    # nor are batches that do not even scan (an unterminated regex name).
+    array = '\x0Babc\x00'
+    array = struct.pack('<i', len(array) + 4) + array
+    head = bson.dumps({'_src' : 'A', '_dst' : 'B', '_ctl' : 'batch'})
+    element = '\x04docs\x00' + array
+    bad = struct.pack('<i', len(head) + len(element)) + head[4:-1] + element \
+      + '\x00'
+    self.assertRaises(BsonScanError, list, elements(array))
+    self.assertFalse(isDocumentArray(bad, 'docs'))
+    self.assertFalse(isDocumentArray('\x05\x00', 'docs'))
+    b.sendall(bad + bson.dumps({'_src' : 'A', '_dst' : 'router'}))
+    conn.readTransport()
+    self.assertTrue(conn.transport.connected)
+    self.assertEqual(factory.metrics.unrouted, 0)
+    self.assertEqual(conn.metrics.docs_in, 2)
+
+    conn.transport.loseConnection()
+    b.close()
+
+  def test_stats(self):
+    path = os.path.join(tempfile.gettempdir(), 'bsonrouter-test-%d.stats' \
+      % os.getpid())
+    with BNProcess('python bsonnetwork/router.py -i router --stats-socket '
+        + path) as r:
+      r.connect('A')
+      r.identify('A')
+      r.connect('B')
+      r.identify('B')
+      r.send_and_receive('A', 'B', {'herp' : 'derp'})
+
+      # clients do not get the stats (they list every client).
+      r._sendobj('A', {'_src' : 'A', '_dst' : 'router', '_ctl' : 'stats'})
+      r.send_and_receive('B', 'A', {'herp' : 'derp'}) # no reply before it.
+
+      sock = gevent.socket.socket(gevent.socket.AF_UNIX)
+      sock.connect(path)
+      stats = json.loads(sock.makefile().read())
+      sock.close()
+      self.assertEqual(len(stats['connections']), 2)
+      self.assertEqual(stats['routes']['B']['docs'], 1)
+      self.assertEqual(stats['routes']['A']['docs'], 1)
+      self.assertEqual(stats['routes']['B']['residency']['count'], 1)
+      self.assertEqual(stats['residency']['count'], 2)
+      self.assertTrue(stats['queue_wait']['count'] >= 4) # ids and forwards.
+
+      r.disconnect('A')
+      r.disconnect('B')
+
+  def test_groups(self):
+    with BNProcess('python bsonnetwork/router.py -i router') as r:
+      for client in ['A', 'B', 'C']:
+        r.connect(client)
+        r.identify(client)
+
+      def control(client, ctl, group):
+        r._sendobj(client, {'_src' : client, '_dst' : 'router', \
+          '_ctl' : ctl, 'group' : group})
+        r.waitForOutput('[%s] sending document' % client)
+        return r._recvobj(client, {})
+
+      for client in ['A', 'B', 'C']:
+        reply = control(client, 'join', '#room')
+        self.assertEqual(reply['_ctl'], 'joinreply')
+        self.assertFalse('error' in reply)
+      self.assertTrue('error' in control('A', 'join', 'B')) # a client.
+      self.assertTrue('error' in control('A', 'join', 'D')) # a client to be.
+
+      # to every member but the sender.
+      doc = {'_src' : 'A', '_dst' : '#room', 'herp' : 'derp'}
+      r.send(doc)
+      for client in ['B', 'C']:
+        r.waitForOutput('[%s] sending document' % client)
+        self.assertEqual(r._recvobj(client, doc), doc)
+
+      self.assertEqual(control('C', 'leave', '#room')['_ctl'], 'leavereply')
+      doc = {'_src' : 'B', '_dst' : '#room', 'seq' : 2}
+      r.send(doc)
+      r.waitForOutput('[A] sending document') # only A left to receive it.
+      self.assertEqual(r._recvobj('A', doc), doc)
+      r.send_and_receive('A', 'C', {'herp' : 'derp'}) # C got nothing else.
+
+      for client in ['A', 'B', 'C']:
+        r.disconnect(client)
+
+
+class TestRouterWorkers(unittest.TestCase):
+
+  def test_send_across_workers(self):
+    clients = ['A', 'B', 'C', 'D', 'E', 'F']
+    with BNProcess('python bsonnetwork/router.py -i router -w 3') as r:
+      for client in clients:
+        r.connect(client)
+        r.identify(client)
+
+      # wait until the other two workers know where each client is.
+      for client in clients:
+        r.waitForOutput('holds client %s' % client)
+        r.waitForOutput('holds client %s' % client)
+
+      # connections are spread over workers by the kernel, so some pairs are
+      # held by different workers and their documents are relayed.
+      for src in clients:
+        for dst in clients:
+          r.send_and_receive(src, dst, {'herp' : 'derp'})
+
+      for client in clients:
+        r.disconnect(client)
+
+
+  def test_link(self):
+    options, args = arg_parser('').parse_args(['-i', 'router', '-l', 'warning'])
+    router = BsonRouterFactory(options.clientid, options)
+    router.logging = logging
+    router.workers = WorkerLinkFactory(router, 0, 2)
+    a, b = gevent.socket.socketpair()
+    link = WorkerLinkProtocol(Transport(a), None, router.workers)
+
+    # a malformed relayed frame is dropped, the link stays up.
+    element = '\x02_dst\x00' + struct.pack('<i', -7) + 'xx\x00'
+    link.receivedFrame(struct.pack('<i', len(element) + 5) + element + '\x00')
+    self.assertEqual(link.metrics.decode_errors, 1)
+    self.assertTrue(link.transport.connected)
+
+    # a client registered here and then on worker 1: the newer one wins.
+    router.routes.add('A', object())
+    link.worker = 1
+    link.receivedBson({'_wkr' : 'add', 'clients' : ['A']})
+    self.assertEqual(router.routes.get('A'), None)
+    self.assertEqual(router.workers.directory, {'A' : 1})
+    link.transport.loseConnection()
+    b.close()
+
+
+class TestRoutingTable(unittest.TestCase):
+
+  def test_clients(self):
+    metrics = Registry()
+    table = RoutingTable(metrics)
+    a, b, b2 = object(), object(), object()
+
+    route = table.add(u'A', a)
+    self.assertTrue(route.clientid is internId('A')) # interned.
+    self.assertTrue(table.route(u'A') is route)
+    self.assertTrue(table.route('A').conn is a)
+    self.assertEqual(table.route('C'), None)
+    self.assertTrue(metrics.routes['A'] is route.metrics)
+
+    table.add('B', b)
+    self.assertEqual(len(table), 2)
+    self.assertEqual(sorted(table.clients()), ['A', 'B'])
+
+    # B reconnects: the new route replaces the old one, whose connection
+    # closing later does not remove it.
+    table.add('B', b2)
+    self.assertEqual(len(table), 2)
+    self.assertFalse(table.remove('B', b))
+    self.assertTrue(table.route('B').conn is b2)
+    self.assertTrue(table.remove('B', b2))
+    self.assertEqual(table.route('B'), None)
+    self.assertFalse('B' in metrics.routes)
+    self.assertEqual(len(table), 1)
+
+  def test_prefixes(self):
+    table = RoutingTable()
+    node, far = object(), object()
+    table.add('node2', node)
+    table.add('far', far)
+    table.addPrefix('node2/', 'node2')
+    table.addPrefix('node2/far/', 'far')
+
+    self.assertTrue(table.route('node2/client').conn is node)
+    self.assertTrue(table.route('node2/far/client').conn is far) # longest.
+    self.assertTrue(table.route('node2').conn is node)
+    self.assertEqual(table.route('node3/client'), None)
+    self.assertEqual(table.route(5), None)
+
+    table.remove('far')
+    self.assertTrue(table.route('node2/far/client').conn is node)
+    self.assertRaises(ValueError, table.addPrefix, 'x/', 'nobody')
+
+  def test_groups(self):
+    table = RoutingTable(Registry())
+    a, b, a2 = object(), object(), object()
+    table.add('A', a)
+    table.add('B', b)
+
+    group = table.join('#room', 'A')
+    table.join('#room', 'B')
+    self.assertTrue(table.route('#room') is group)
+    self.assertEqual(sorted(group.members.keys()), ['A', 'B'])
+    self.assertEqual(len(table), 2) # groups are not clients.
+    self.assertEqual(sorted(table.clients()), ['A', 'B'])
+
+    # memberships follow reconnections.
+    table.add('A', a2)
+    self.assertTrue(group.members['A'].conn is a2)
+
+    self.assertRaises(ValueError, table.join, 'A', 'B') # a client address.
+    self.assertRaises(ValueError, table.add, '#room', a) # a group address.
+    self.assertRaises(ValueError, table.join, '#room', 'nobody')
+    self.assertRaises(ValueError, table.join, 'C', 'A') # not a group name.
+    self.assertRaises(ValueError, table.add, '#other', b) # nor a client id.
+    self.assertEqual(table.get('C'), None)
+
+    self.assertTrue(table.leave('#room', 'B'))
+    self.assertFalse(table.leave('#room', 'B'))
+    table.remove('A')
+    self.assertEqual(table.route('#room'), None) # emptied.
+
+
+
+class TestPipelining(unittest.TestCase):
+
+  def setUp(self):
+    options, args = arg_parser('').parse_args(['-i', 'router', '-l', 'warning'])
+    self.factory = BsonRouterFactory(options.clientid, options)
+    self.factory.logging = logging
+    self.server = Server(('127.0.0.1', 0), self.factory)
+    self.server.serve()
+    self.address = ('127.0.0.1', self.server.server.server_port)
+
+  def tearDown(self):
+    self.server.server.stop(timeout=0)
+
+  def test_window(self):
+    a = Connection('A', self.address, window=4)
+    b = Connection('B', self.address)
+    self.assertEqual(a.remoteid, 'router')
+    with gevent.Timeout(5):
+      while len(self.factory.routes) < 2: # identified, routable.
+        gevent.sleep(0.01)
+
+    # 4 in flight: the 5th send waits for a document back.
+    for i in range(0, 4):
+      a.send({'_dst' : 'B', 'seq' : i})
+    blocked = gevent.spawn(a.send, {'_dst' : 'B', 'seq' : 4})
+    gevent.sleep(0.1)
+    self.assertFalse(blocked.ready())
+
+    received = iter(b)
+    for i in range(0, 5):
+      if i == 1:
+        b.send({'_dst' : 'A'}) # frees one slot.
+        a.recv()
+        blocked.join(1)
+      self.assertEqual(received.next()['seq'], i)
+    self.assertTrue(blocked.ready())
+    self.assertEqual(a.outstanding, 4)
+
+    # documents beyond the requests sent do not widen the window.
+    for i in range(0, 6):
+      b.send({'_dst' : 'A'})
+    for i in range(0, 6):
+      a.recv()
+    self.assertEqual(a.outstanding, 0)
+    self.assertEqual(a.window.counter, 4)
+
+    self.factory.routes.get('B').conn.transport.loseConnection()
+    with gevent.Timeout(5):
+      self.assertEqual(list(received), []) # ends when closed.
+    a.close()
+    b.close()
+
+  def test_pipeline(self):
+    pair = ConnectionPair('P', self.address, window=16)
+    pair.pipeline(200)
+    self.assertEqual(pair.stats['sent'], 400)
+    self.assertEqual(pair.rtt.count, 200)
+    self.assertEqual(pair.c1.stats['recv'], 200)
+    pair.close()
+
+  def test_group_member(self):
+    received = []
+
+    class Member(BsonNetworkProtocol):
+      def receivedMessage(self, msg):
+        received.append(msg)
+
+    options, args = arg_parser('').parse_args(['-i', 'M', '-l', 'warning'])
+    member = BsonNetworkFactory('M', options)
+    member.protocol = Member
+    member.logging = logging
+    client = Client.spawn(member, self.address)
+    with gevent.Timeout(5):
+      while client.connection is None or not client.connection.clientid:
+        gevent.sleep(0.01)
+    client.connection.sendMessage({'_ctl' : 'join', 'group' : '#room'})
+
+    a = Connection('A', self.address)
+    with gevent.Timeout(5):
+      while not self.factory.routes.get('#room'):
+        gevent.sleep(0.01)
+
+    # library members get group documents (and batches) as messages.
+    a.send({'_dst' : '#room', 'seq' : 0})
+    a.send({'_dst' : '#room', '_ctl' : 'batch',
+      'docs' : [{'seq' : 1}, {'seq' : 2}]})
+    with gevent.Timeout(5):
+      while len(received) < 3:
+        gevent.sleep(0.01)
+    self.assertEqual([msg['seq'] for msg in received], [0, 1, 2])
+    self.assertEqual(set(msg['_dst'] for msg in received), set(['#room']))
+    self.assertEqual(set(msg['_src'] for msg in received), set(['A']))
+
+    a.close()
+    client.disconnect()
+
+
+
+class TestRouterMemory(unittest.TestCase):
+  '''Idle connections must stay cheap. Opens `connections` identified
+  loopback clients (env BSONNETWORK_TEST_CONNECTIONS) against an in process
+  router and checks the memory (RSS) they add, both ends included. The
+  default is kept small; set e.g. 100000 for a stress run.'''
+
+  connections = int(os.environ.get('BSONNETWORK_TEST_CONNECTIONS', 500))
+  # bytes per idle connection. About 9k of it is the parked reader greenlet
+  # (its saved stack and frames) and 1k the two gevent sockets.
+  budget = 16384
+
+  @staticmethod
+  def rss():
+    with open('/proc/self/status') as status:
+      for line in status:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1]) * 1024
+
+  def test_idle_connections(self):
+    count = self.connections
+    if raiseFileLimit() < 2 * count + 256:
+      self.skipTest('open files limit too low for %d connections' % count)
+
+    parser = arg_parser('usage: %prog [options]')
+    options, args = parser.parse_args(['-i', 'router', '-c', str(count), \
+      '-l', 'warning'])
+    factory = BsonRouterFactory(options.clientid, options)
+    factory.logging = logging
+    server = Server(('127.0.0.1', 0), factory, max_connections=count, \
+      backlog=1024)
+    server.serve()
+    port = server.server.server_port
+
+    gc.collect()
+    before = self.rss()
+
+    socks = []
+    for i in xrange(0, count):
+      # spread over source addresses, as each has ~28k ephemeral ports.
+      source = ('127.0.0.%d' % (1 + i / 20000), 0)
+      sock = gevent.socket.create_connection(('127.0.0.1', port), \
+        source_address=source)
+      sock.sendall(bson.dumps({'_src' : 'client%d' % i}))
+      socks.append(sock)
+
+    with gevent.Timeout(60):
+      while len(factory.routes) < count:
+        gevent.sleep(0.1)
+    gevent.sleep(0.5) # let the last connections settle.
+
+    gc.collect()
+    per_connection = (self.rss() - before) / count
+    self.assertTrue(per_connection < self.budget, 'idle connection '
+      'footprint: %d bytes (%d connections)' % (per_connection, count))
+
+    server.server.stop(timeout=0)
+    for sock in socks:
+      sock.close()
+
+
 
 def clientid(num):
   return 'client%d' % int(num)
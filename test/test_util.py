@@ -1,15 +1,52 @@
 
 import bson
+import time
+import struct
+import random
+import logging
+import gevent
+import gevent.socket
 import unittest
 import socket
 
 from bsonnetwork.util import test
 from bsonnetwork.util import BsonReceiveBuffer
+from bsonnetwork.util.bsonscan import scanFields, elements, BsonScanError
+from bsonnetwork.util.bsonscan import LazyDocument, BsonValueError
+from bsonnetwork.util.bsonscan import encodeDocument
+from bsonnetwork.util.logger import Logger
+from bsonnetwork.util import bsoncodec
+from bsonnetwork.util.metrics import Histogram, Registry
 
-from bsonnetwork.protocol import BsonProtocol
+from bsonnetwork.base import Transport, Server, Factory, Protocol, RateLimiter
+from bsonnetwork.base import YieldPolicy
+from bsonnetwork import base
+from bsonnetwork.protocol import BsonProtocol, BsonFactory, LengthExceededError
 
 import utils
 
+
+def clog(sock):
+  '''Fills the kernel send buffer of gevent socket `sock`, so that writes to
+  it get queued. Returns the number of bytes it took.'''
+  clogged = 0
+  sock.settimeout(0)
+  try:
+    while True:
+      clogged += sock.send('x' * 65536)
+  except socket.error:
+    pass
+  sock.settimeout(None)
+  return clogged
+
+
+def receive(sock, size):
+  data = ''
+  while len(data) < size:
+    data += sock.recv(65536)
+  return data
+
+
 class TestUtil(unittest.TestCase):
 
   def test_bsonbuffer(self):
@@ -62,6 +99,59 @@ class TestUtil(unittest.TestCase):
     self.assertFalse(buf.hasNext())
 
 
+  def test_bsonbuffer_pipelined(self):
+
+    docs = [utils.random_dict() for i in range(0, 200)]
+    data = ''.join(bson.dumps(doc) for doc in docs)
+
+    buf = BsonReceiveBuffer()
+
+    # odd sized chunks, so documents straddle appends and compactions.
+    received = []
+    for i in range(0, len(data), 1000):
+      buf.append(data[i:i+1000])
+      while buf.hasNext():
+        received.append(buf.next())
+
+    self.assertEqual(received, docs)
+    self.assertEqual(len(buf), 0)
+    self.assertEqual(buf.nextLength(), 0)
+    self.assertEqual(buf.next(), None)
+
+    # everything in one read.
+    buf.append(data)
+    for doc in docs:
+      self.assertEqual(buf.next(), doc)
+    self.assertEqual(len(buf), 0)
+    self.assertTrue(len(buf.buffer) <= buf.idle_capacity)
+
+
+  def test_bsonscan(self):
+
+    for i in range(0, 50):
+      doc = utils.random_dict()
+      doc['_src'] = utils.random_string()
+      doc['_dst'] = 'client%d' % i
+      data = bson.dumps(doc)
+
+      names = [name for name, etype, start, end in elements(data)]
+      self.assertEqual(sorted(names), sorted(doc.keys()))
+
+      header = scanFields(data, ('_src', '_dst', '_ctl'))
+      self.assertEqual(header, {'_src' : doc['_src'], '_dst' : doc['_dst']})
+
+      key = random.choice(doc.keys())
+      self.assertEqual(scanFields(data, (key,)), {key : doc[key]})
+
+    # lengths that would move the scan backwards are rejected.
+    for etype, length in [('\x02', -7), ('\x02', 0), ('\x03', -20),
+        ('\x04', 3), ('\x05', -5), ('\x0F', 4)]:
+      element = etype + 'a\x00' + struct.pack('<i', length) + 'xx\x00'
+      data = struct.pack('<i', len(element) + 5) + element + '\x00'
+      self.assertRaises(BsonScanError, scanFields, data, ('_src', '_dst'))
+      self.assertRaises(BsonScanError, list, elements(data))
+
+
   def test_bsonrecv(self):
 
     class ProtocolTest(BsonProtocol):
@@ -105,5 +195,626 @@ class TestUtil(unittest.TestCase):
     ProtocolTest([mf, mf, mf, mf, mf])
     ProtocolTest([mf, mf, mf, mf, mf])
 
+
+  def test_lazydocument(self):
+
+    body = dict(('%d' % i, utils.random_dict()) for i in range(0, 20))
+    doc = {'_src' : 'A', '_dst' : 'B', 'n' : 5, 'body' : body,
+      'list' : [1, 'two', {'three' : 3.0}]}
+    data = bson.dumps(doc)
+
+    lazy = LazyDocument(data)
+    self.assertEqual(len(lazy), 5)
+    self.assertTrue('body' in lazy)
+    self.assertFalse('nope' in lazy)
+    self.assertEqual(sorted(lazy.keys()), sorted(doc.keys()))
+    self.assertEqual(lazy['_src'], 'A')
+    self.assertEqual(lazy.get('n'), 5)
+    self.assertEqual(lazy.get('nope', 7), 7)
+    self.assertRaises(KeyError, lambda: lazy['nope'])
+    self.assertEqual(sorted(lazy.decoded.keys()), ['_src', 'n']) # only these.
+    self.assertTrue(lazy.encode() is data) # unchanged: the same bytes.
+    self.assertEqual(lazy['list'], doc['list'])
+    self.assertTrue(test.dicts_equal(lazy['body'], body))
+    self.assertTrue(test.dicts_equal(bson.loads(lazy.encode()), doc))
+
+    # changes turn it into a plain dict.
+    lazy = LazyDocument(data)
+    lazy['_dst'] = 'C'
+    del lazy['n']
+    self.assertEqual(lazy.data, None)
+    self.assertEqual(len(lazy), 4)
+    self.assertEqual(lazy['_dst'], 'C')
+    self.assertFalse('n' in lazy)
+    changed = bson.loads(lazy.encode())
+    self.assertEqual(changed['_dst'], 'C')
+    self.assertTrue(test.dicts_equal(changed['body'], body))
+    self.assertEqual(encodeDocument({'a' : 1}), bson.dumps({'a' : 1}))
+
+    self.assertRaises(BsonScanError, LazyDocument, data[:-1])
+
+    # nested values handed out may be changed in place: no stale bytes.
+    lazy = LazyDocument(data)
+    self.assertEqual(lazy['n'], 5)
+    self.assertTrue(lazy.encode() is data) # scalars cannot change.
+    lazy['body']['0'] = 'changed'
+    self.assertEqual(bson.loads(lazy.encode())['body']['0'], 'changed')
+    lazy = LazyDocument(data)
+    lazy.copy()['list'].append(4) # shallow copies share them too.
+    self.assertEqual(bson.loads(lazy.encode())['list'][-1], 4)
+
+    # values that do not decode fail when read, as BsonScanErrors.
+    bad = bson.dumps({'ok' : 1, 's' : u'abc'}).replace('abc', 'a\xffc')
+    lazy = LazyDocument(bad)
+    self.assertEqual(lazy['ok'], 1)
+    self.assertRaises(BsonValueError, lambda: lazy['s'])
+    self.assertTrue(issubclass(BsonValueError, BsonScanError))
+
+    # protocols decode lazily when asked to.
+    class LazyTest(BsonProtocol):
+      lazy_documents = True
+      received = []
+
+      def receivedBson(self, doc):
+        self.received.append(doc)
+
+    proto = LazyTest(None, None, None)
+    proto.receivedData(data + data[:-1] + '\x01')
+    self.assertEqual(len(proto.received), 1)
+    self.assertTrue(isinstance(proto.received[0], LazyDocument))
+    self.assertEqual(proto.received[0]['_dst'], 'B')
+    self.assertEqual(proto.metrics.decode_errors, 1)
+
+    # a value read by the handler that does not decode is a decoding error,
+    # and the connection goes on.
+    class ReadingTest(LazyTest):
+      received = []
+      errors = []
+
+      def receivedBson(self, doc):
+        self.received.append(doc['s'])
+
+      def bsonDecodingError(self, error):
+        self.errors.append(error)
+
+    proto = ReadingTest(None, None, None)
+    proto.receivedData(bad + bson.dumps({'s' : u'fine'}))
+    self.assertEqual(proto.received, [u'fine'])
+    self.assertEqual(len(proto.errors), 1)
+    self.assertTrue(isinstance(proto.errors[0], BsonValueError))
+    self.assertEqual(proto.errors[0].bsonData, bad)
+    self.assertEqual(proto.metrics.decode_errors, 1)
+
+
+  def test_bsonreadinto(self):
+
+    class ProtocolTest(BsonProtocol):
+      def __init__(self, transport):
+        self.transport = transport
+        self.received = []
+
+      def receivedBson(self, bsonDoc):
+        self.received.append(bsonDoc)
+
+    mf = {}
+    for i in range(0, 500):
+      mf['%d' % i] = utils.random_dict()
+    docs = [utils.random_dict() for i in range(0, 20)] + [mf]
+
+    def send(sock):
+      sock.sendall(''.join(bson.dumps(doc) for doc in docs))
+      sock.close()
+
+    a, b = gevent.socket.socketpair()
+    gevent.spawn(send, a)
+
+    proto = ProtocolTest(Transport(b))
+    while proto.readTransport():
+      # reads grow to cover the large document's missing bytes.
+      self.assertTrue(proto.readSize() <= proto.max_read_size)
+
+    self.assertEqual(proto.received, docs)
+    proto.transport.loseConnection()
+
+
+  def test_bsonstream(self):
+
+    class StreamTest(BsonProtocol):
+      stream_size = 4
+
+    docs = [{'seq' : i, 'pad' : 'x' * 65536} for i in range(0, 40)]
+    data = ''.join(bson.dumps(doc) for doc in docs)
+
+    a, b = gevent.socket.socketpair()
+    factory = BsonFactory()
+    proto = StreamTest(Transport(b), None, factory)
+    reader = gevent.spawn(factory.transportRead, proto)
+    sender = gevent.spawn(a.sendall, data)
+
+    # nobody consumes: the reader stops, and so does the sender.
+    gevent.sleep(0.1)
+    self.assertEqual(len(proto.stream), 4)
+    self.assertFalse(sender.ready())
+    self.assertFalse(reader.ready())
+
+    received = []
+    workers = proto.streamWorkers(received.append, 3)
+    sender.join(5)
+    self.assertTrue(sender.ready())
+    a.close()
+    reader.join(5)
+    gevent.joinall(workers, timeout=5) # end with the connection.
+    self.assertTrue(all(worker.ready() for worker in workers))
+    self.assertEqual(sorted(doc['seq'] for doc in received), range(0, 40))
+    self.assertEqual(list(proto.documents()), [])
+    proto.transport.loseConnection()
+
+    # raw frames.
+    StreamTest.decode_frames = False
+    a, b = gevent.socket.socketpair()
+    proto = StreamTest(Transport(b), None, factory)
+    gevent.spawn(factory.transportRead, proto)
+    sender = gevent.spawn(a.sendall, data)
+    sender.link(lambda g: a.close())
+    with gevent.Timeout(5):
+      self.assertEqual(''.join(proto.documents()), data)
+    proto.transport.loseConnection()
+
+
+  def test_bsonframes(self):
+
+    class FrameTest(BsonProtocol):
+      decode_frames = False
+      max_bytes = 1024
+
+      def __init__(self, transport):
+        BsonProtocol.__init__(self, transport, None, None)
+        self.frames = []
+
+      def receivedFrame(self, frame):
+        self.frames.append(frame)
+
+    docs = [{'seq' : i, 'herp' : 'derp'} for i in range(0, 20)]
+    data = [bson.dumps(doc) for doc in docs]
+    a, b = gevent.socket.socketpair()
+    proto = FrameTest(Transport(b))
+    proto.receivedData(''.join(data) + '\x05\x00\x00\x00\xff')
+    self.assertEqual(proto.frames, data + ['\x05\x00\x00\x00\xff'])
+    self.assertEqual(proto.metrics.decode_errors, 0) # never decoded.
+    self.assertEqual(proto.decodeFrame(data[0]), docs[0])
+    self.assertEqual(proto.decodeFrame('\x05\x00\x00\x00\xff'), None)
+    self.assertEqual(proto.metrics.decode_errors, 1)
+
+    # frames are sent as they are, within max_bytes.
+    self.assertTrue(proto.sendFrame(data[0]))
+    self.assertEqual(receive(a, len(data[0])), data[0])
+    big = bson.dumps({'x' : 'y' * 2048})
+    self.assertRaises(LengthExceededError, proto.sendFrame, big)
+    proto.transport.loseConnection()
+
+    # lengths too small to frame anything disconnect, like oversized ones,
+    # rather than buffering whatever follows for good.
+    for prefix in [-1, 0, 4, -2 ** 31]:
+      a, b = gevent.socket.socketpair()
+      proto = FrameTest(Transport(b))
+      proto.receivedData(data[0] + struct.pack('<i', prefix)[:2])
+      self.assertTrue(proto.transport.connected) # not a full prefix yet.
+      proto.receivedData(struct.pack('<i', prefix)[2:] + data[1])
+      self.assertEqual(proto.frames, data[:1])
+      self.assertFalse(proto.transport.connected)
+      a.close()
+
+
+  def test_yield_policy(self):
+
+    policy = YieldPolicy(docs=3, bytes=100, micros=0)
+    budget = policy.budget()
+    self.assertEqual([budget.spend(10) for i in range(0, 6)],
+      [False, False, True, False, False, True])
+    self.assertTrue(budget.spend(100)) # bytes.
+    self.assertEqual(policy.yields, 3)
+
+    budget = YieldPolicy(docs=0, bytes=0, micros=1000).budget()
+    self.assertFalse(budget.spend())
+    time.sleep(0.002)
+    self.assertTrue(budget.spend())
+
+    # the reader of a connection yields as its transport's policy says.
+    class ProtocolTest(BsonProtocol):
+      def receivedBson(self, bsonDoc):
+        pass
+
+    a, b = gevent.socket.socketpair()
+    policy = YieldPolicy(docs=4, bytes=0, micros=0)
+    proto = ProtocolTest(Transport(b, yield_policy=policy), None, None)
+    a.sendall(''.join(bson.dumps({'seq' : i}) for i in range(0, 10)))
+    a.close()
+    while proto.readTransport():
+      pass
+    self.assertEqual(proto.metrics.docs_in, 10)
+    self.assertEqual(proto.metrics.yields, 2)
+    self.assertEqual(policy.yields, 2)
+    proto.transport.loseConnection()
+
+
+  def test_transport_direct(self):
+
+    a, b = gevent.socket.socketpair()
+    transport = Transport(a)
+
+    # idle connection: written by the caller, no flusher greenlet.
+    data = bson.dumps(utils.random_dict())
+    self.assertTrue(transport.write(data))
+    self.assertEqual(transport.flusher, None)
+    self.assertEqual(transport.queue, None)
+    self.assertEqual(transport.metrics.sends, 1)
+    self.assertEqual(b.recv(65536), data)
+
+    # a write the socket only partly takes: the rest is flushed.
+    clogged = clog(a)
+    receive(b, clogged)
+    big = 'y' * (clogged * 2)
+    self.assertTrue(transport.write(big))
+    self.assertNotEqual(transport.flusher, None)
+    self.assertEqual(receive(b, len(big)), big)
+    gevent.sleep(0)
+    self.assertEqual(transport.flusher, None) # retired.
+    self.assertEqual(transport.queue, None)
+    self.assertEqual(transport.metrics.bytes_out, len(data) + len(big))
+    self.assertEqual(transport.metrics.docs_out, 2)
+
+    transport.loseConnection()
+    self.assertFalse(transport.write(data))
+    b.close()
+
+
+  def test_transport_public_socket(self):
+
+    class PublicSocket(object):
+      '''Only the public gevent socket methods (no raw socket underneath).'''
+      def __init__(self, sock):
+        self.sock = sock
+      def __getattr__(self, name):
+        if name.startswith('_'):
+          raise AttributeError(name)
+        return getattr(self.sock, name)
+
+    a, b = gevent.socket.socketpair()
+    transport = Transport(PublicSocket(a))
+    self.assertEqual(base.raw_socket(transport.sock), None)
+
+    data = bson.dumps(utils.random_dict())
+    self.assertTrue(transport.write(data)) # queued, sent by the flusher.
+    self.assertEqual(receive(b, len(data)), data)
+
+    buf = bytearray(65536)
+    waiter = gevent.spawn(transport.waitReadable)
+    gevent.sleep(0.01)
+    self.assertFalse(waiter.ready())
+    b.sendall(data)
+    waiter.join(timeout=1)
+    self.assertTrue(waiter.successful())
+    self.assertEqual(transport.readIntoNow(buf, len(buf)), len(data))
+    self.assertEqual(str(buf[:len(data)]), data)
+
+    # closing the connection wakes up an idle reader.
+    def idle():
+      try:
+        transport.waitReadable()
+      except socket.error:
+        return 'closed'
+    waiter = gevent.spawn(idle)
+    gevent.sleep(0.01)
+    transport.loseConnection()
+    self.assertEqual(waiter.get(timeout=1), 'closed')
+    b.close()
+
+
+  def test_transport_batching(self):
+
+    a, b = gevent.socket.socketpair()
+    transport = Transport(a)
+    clogged = clog(a)
+
+    data = [bson.dumps(utils.random_dict()) for i in range(0, 100)]
+    for d in data:
+      transport.write(d) # queued without yielding, so flushed in batches.
+
+    expected = ''.join(data)
+    received = receive(b, clogged + len(expected))[clogged:]
+
+    self.assertEqual(received, expected)
+    self.assertEqual(transport.metrics.docs_out, len(data))
+    self.assertEqual(transport.metrics.bytes_out, len(expected))
+    self.assertTrue(transport.metrics.sends < len(data))
+    self.assertEqual(transport.metrics.send_latency.count,
+      transport.metrics.sends)
+
+    transport.loseConnection()
+    b.close()
+
+
+  def test_transport_queue_policies(self):
+
+    class WatermarkProtocol(object):
+      def __init__(self):
+        self.calls = []
+      def sendQueueHigh(self):
+        self.calls.append('high')
+      def sendQueueLow(self):
+        self.calls.append('low')
+
+    data = ['%03d' % i + 'x' * 97 for i in range(0, 50)] # 100 bytes each.
+
+    def fill(policy):
+      a, b = gevent.socket.socketpair()
+      transport = Transport(a, queue_bytes=1000, queue_policy=policy)
+      transport.protocol = WatermarkProtocol()
+      # the socket is full and there are no yields here, so nothing is sent
+      # while filling.
+      clogged = clog(a)
+      written = [transport.write(d) for d in data]
+      return transport, b, written, clogged
+
+    transport, b, written, clogged = fill('drop-newest')
+    self.assertEqual(written, [True] * 10 + [False] * 40)
+    self.assertEqual([d for d, t in transport.queue.items], data[:10])
+    self.assertEqual(transport.metrics.drops, 40)
+    self.assertEqual(transport.protocol.calls, ['high'])
+    received = receive(b, clogged + 1000)[clogged:]
+    self.assertEqual(received, ''.join(data[:10]))
+    self.assertEqual(transport.protocol.calls, ['high', 'low'])
+    transport.loseConnection()
+
+    transport, b, written, clogged = fill('drop-oldest')
+    self.assertEqual(written, [True] * 50)
+    self.assertEqual([d for d, t in transport.queue.items], data[-10:])
+    self.assertEqual(transport.metrics.drops, 40)
+    transport.loseConnection()
+
+    transport, b, written, clogged = fill('disconnect')
+    self.assertEqual(written, [True] * 10 + [False] * 40)
+    self.assertFalse(transport.connected)
+    transport.loseConnection()
+
+    self.assertRaises(ValueError, Transport, b, queue_policy='herp')
+
+
+  def test_logger(self):
+
+    class Handler(logging.Handler):
+      def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+      def emit(self, record):
+        self.messages.append(record.getMessage())
+
+    class Loud(object):
+      def __str__(self):
+        raise AssertionError('formatted a disabled message')
+
+    handler = Handler()
+    log = logging.getLogger('bsonnetwork.test_logger')
+    log.propagate = False
+    log.addHandler(handler)
+    log.setLevel(logging.WARNING)
+
+    logger = Logger(log)
+    self.assertFalse(logger.isEnabled('info'))
+    self.assertTrue(logger.isEnabled('warning'))
+    logger.info('ignored %s', Loud())
+    logger.warning('kept %s %d', 'herp', 3)
+    self.assertEqual(handler.messages, ['kept herp 3'])
+
+    log.setLevel(logging.DEBUG) # picked up without an explicit refresh.
+    self.assertTrue(logger.isEnabled('debug'))
+    logger.debug('derp')
+    self.assertEqual(handler.messages, ['kept herp 3', 'derp'])
+    log.removeHandler(handler)
+
+  def test_codecs(self):
+    self.assertTrue(bsoncodec.default_codec.name in bsoncodec.available())
+    self.assertRaises(ValueError, bsoncodec.codec, 'herp')
+
+    docs = [utils.random_dict() for i in range(0, 20)]
+    for name in bsoncodec.available():
+      codec = bsoncodec.codec(name)
+      for doc in docs:
+        self.assertEqual(codec.loads(codec.dumps(doc)), doc)
+        self.assertEqual(str(codec.dumps(doc)), bson.dumps(doc))
+
+    class Codec(bsoncodec.Codec):
+      def __init__(self):
+        self.calls = 0
+      def loads(self, data):
+        self.calls += 1
+        return bson.loads(data)
+
+    class Proto(BsonProtocol):
+      def receivedBson(self, doc):
+        self.received = doc
+
+    factory = BsonFactory()
+    factory.codec = Codec()
+    conn = Proto(None, None, factory)
+    conn.receivedData(bson.dumps({'herp' : 'derp'}))
+    self.assertEqual(conn.received, {'herp' : 'derp'})
+    self.assertEqual(factory.codec.calls, 1)
+    self.assertTrue(Proto(None, None, None).codec is bsoncodec.default_codec)
+
+  def test_metrics(self):
+    hist = Histogram()
+    for value in range(1, 1001):
+      hist.record(value)
+    self.assertEqual(hist.count, 1000)
+    self.assertEqual(hist.max, 1000)
+    self.assertTrue(500 <= hist.percentile(50) <= 500 * 1.0625)
+    self.assertTrue(990 <= hist.percentile(99) <= 1000)
+    self.assertTrue(hist.percentile(99.9) <= 1000)
+    self.assertEqual(hist.percentile(100), 1000)
+    self.assertEqual(Histogram().percentile(99), 0)
+
+    big = Histogram()
+    big.record(10 ** 9)
+    big.record(-1) # clamped to 0.
+    self.assertTrue(len(big.counts) < 1024) # bounded storage.
+    hist.merge(big)
+    self.assertEqual(hist.count, 1002)
+    self.assertEqual(hist.percentile(100), 10 ** 9)
+
+    class Proto(BsonProtocol):
+      def receivedBson(self, doc):
+        pass
+
+    a, b = gevent.socket.socketpair()
+    factory = BsonFactory()
+    factory.metrics = Registry()
+    transport = Transport(a)
+    conn = Proto(transport, 'pair', factory)
+    factory.metrics.connectionAdded(conn)
+
+    data = bson.dumps({'herp' : 'derp'})
+    b.sendall(data * 3 + '\x05\x00\x00\x00\x01') # one undecodable.
+    while conn.metrics.docs_in < 4:
+      conn.readTransport()
+    conn.sendBsonData(data)
+    self.assertEqual(b.recv(1024), data)
+
+    stats = factory.metrics.dump()['connections'][0]
+    self.assertEqual(stats['bytes_in'], len(data) * 3 + 5)
+    self.assertEqual(stats['docs_in'], 4)
+    self.assertEqual(stats['decode_errors'], 1)
+    self.assertEqual(stats['bytes_out'], len(data))
+    self.assertEqual(stats['docs_out'], 1)
+    self.assertEqual(stats['send_latency']['count'], 1)
+    self.assertEqual(stats['queue_wait']['count'], 1)
+    self.assertEqual(stats['queue_bytes'], 0)
+
+    conn.metrics.yields = 3
+    factory.metrics.started -= 2 # seconds.
+    factory.metrics.connectionRemoved(conn)
+    dump = factory.metrics.dump()
+    self.assertEqual(dump['connections'], [])
+    self.assertEqual(dump['yields'], 3) # kept past the connection.
+    self.assertTrue(dump['uptime'] >= 2)
+    self.assertTrue(0 < dump['yields_per_sec'] <= 1.5)
+
+    factory.metrics.route(u'caf\xe9') # non-ascii ids dump as they are.
+    self.assertTrue(u'caf\xe9' in factory.metrics.dump()['routes'])
+    transport.loseConnection()
+    b.close()
+
+  def test_bench_openloop(self):
+    from bsonnetwork.util.bench import dueTimes, OpenLoopStats, \
+      openLoopReceive, mergeOpenLoopResults
+
+    self.assertEqual(list(dueTimes(10.0, 4, 1.0)),
+      [(0, 10.0), (1, 10.25), (2, 10.5), (3, 10.75)])
+    self.assertEqual(len(list(dueTimes(0.0, 100.0, 2.5))), 250)
+    self.assertEqual(list(dueTimes(0.0, 3, 0.1)), [])
+
+    class FakeConnection(list):
+      clientid = 'fake'
+
+    stats = OpenLoopStats()
+    stats.sent = 4
+    now = time.time()
+    openLoopReceive(FakeConnection([{'_t' : now}, {'_t' : now - 0.001},
+      {'herp' : 'derp'}, {'_t' : 'then'}]), stats)
+    self.assertEqual(stats.received, 2)
+    self.assertEqual(stats.errors, 2)
+    self.assertEqual(stats.latency.count, 2)
+    self.assertTrue(stats.latency.max >= 1000) # microseconds.
+
+    result = stats.result(10.0, 2, 2.0)
+    self.assertEqual(result['offered'], 20.0)
+    self.assertEqual(result['lost'], 2)
+    self.assertEqual(result['throughput'], 1.0)
+
+    merged = mergeOpenLoopResults([result, stats.result(10.0, 2, 4.0)])
+    self.assertEqual(merged['connections'], 4)
+    self.assertEqual(merged['sent'], 8)
+    self.assertEqual(merged['elapsed'], 4.0)
+    self.assertEqual(merged['throughput'], 1.0)
+    self.assertEqual(merged['latency_us']['count'], 4)
+
+  def test_bench_scenarios(self):
+    from bsonnetwork.util.scenarios import scenarios, payloadSizes
+
+    pairs = scenarios['pairs']('c', 5)
+    self.assertEqual(pairs.senders(), ['c0', 'c1', 'c2', 'c3'])
+    self.assertEqual(pairs.receivers(), pairs.senders())
+    self.assertEqual(pairs.destination('c2', 0), 'c3')
+    self.assertEqual(pairs.destination('c3', 7), 'c2')
+
+    fanin = scenarios['fanin']('c', 4)
+    self.assertEqual(fanin.senders(), ['c0', 'c1', 'c2'])
+    self.assertEqual(fanin.receivers(), ['chot'])
+    self.assertEqual(fanin.destination('c1', 3), 'chot')
+
+    fanout = scenarios['fanout']('c', 4)
+    self.assertEqual(fanout.senders(), ['csource'])
+    self.assertEqual(fanout.receivers(), ['c0', 'c1', 'c2'])
+    self.assertEqual([fanout.destination('csource', i) for i in range(4)],
+      ['c0', 'c1', 'c2', 'c0'])
+
+    alltoall = scenarios['alltoall']('c', 3)
+    self.assertEqual(alltoall.senders(), ['c0', 'c1', 'c2'])
+    self.assertEqual(alltoall.receivers(), alltoall.senders())
+    for sender in alltoall.senders():
+      seen = set(alltoall.destination(sender, i) for i in range(100))
+      self.assertEqual(seen, set(alltoall.senders()) - set([sender]))
+
+    # every scenario needs at least a sender and a receiver.
+    for scenario in scenarios.values():
+      self.assertTrue(scenario('c', 0).senders())
+      self.assertTrue(scenario('c', 0).receivers())
+
+    sizes = payloadSizes(1000, smallest=10, factor=4)
+    self.assertEqual(sizes, [10, 40, 160, 640, 872])
+    self.assertEqual(payloadSizes(178), [50])
+    self.assertRaises(ValueError, payloadSizes, 100)
+    self.assertEqual(payloadSizes()[0], 50)
+    self.assertEqual(payloadSizes()[-1], 16777216 - 128)
+    self.assertEqual(sorted(payloadSizes()), payloadSizes())
+
+  def test_server_admission(self):
+
+    class HoldProtocol(Protocol):
+      def connectionMade(self):
+        self.factory.open.append(self)
+      def connectionLost(self, reason):
+        self.factory.open.remove(self)
+
+    factory = Factory()
+    factory.protocol = HoldProtocol
+    factory.open = []
+    server = Server(('127.0.0.1', 0), factory, max_connections=2, backlog=8)
+    server.serve()
+    address = ('127.0.0.1', server.server.server_port)
+
+    socks = []
+    for i in range(0, 3):
+      sock = gevent.socket.create_connection(address)
+      socks.append(sock)
+    gevent.sleep(0.1)
+    self.assertEqual(len(factory.open), 2) # the third waits in the backlog.
+
+    socks[0].close()
+    gevent.sleep(0.1)
+    self.assertEqual(len(factory.open), 2) # and is let in once there is room.
+
+    for sock in socks:
+      sock.close()
+    gevent.sleep(0.1)
+    self.assertEqual(len(factory.open), 0)
+    server.server.stop()
+
+    limiter = RateLimiter(100, burst=1)
+    tic = time.time()
+    for i in range(0, 11):
+      limiter.wait()
+    self.assertTrue(time.time() - tic >= 0.09)
+
 if __name__ == '__main__':
   unittest.main()
@@ -29,47 +29,8 @@ class BsonSocket(socket.socket):
 
     return bson.loads(data)
 
-import random
-
-def random_object():
-  fns = [random_dict, \
-         random_list, \
-         random_int, random_int, random_int, \
-         random_int, random_int, random_int, \
-         random.random, random.random, random.random, \
-         random_string, random_string]
-  return random.choice(fns)()
-
-def random_dict():
-  def random_key():
-    key = ''
-    for i in range(0, 10):
-      key += chr(random.randint(ord('A'), ord('Z')))
-    return key
-
-  elems = random.randint(1, 7)
-  dictionary = {}
-  for r in range(0, elems):
-    dictionary[random_key()] = random_object()
-  return dictionary
-
-def random_list():
-  elems = random.randint(1, 7)
-  seq = []
-  for r in range(0, elems):
-    seq.append(random_object())
-  return seq
-
-def random_string():
-  length = random.randint(1, 256)
-
-  string = ''
-  for i in range(0, length):
-    string += chr(random.randint(1, 126))
-  return string
-
-def random_int():
-  return random.randint(0, 10000)
+from bsonnetwork.util.randomdoc import random_object, random_dict, \
+  random_list, random_string, random_int
 
 def dicts_equal(doc, doc2):
   return not any(True for k in doc if str(k) not in doc2) \